@@ -0,0 +1,142 @@
+"""Benchmarks of the excel reader and of the model
+
+Generates synthetic workbooks (see synthetic) for several numbers of neurons and times separately:
+    parse      reading the tabs of an intensity/volume file pair (no cache)
+    match      matching the neurons of a file pair and selecting them for all channels (match_neurons,
+               get_membrane_data)
+    build      build_research_data on the whole synthetic dataset
+    save_json  save_model in json          load_json  load_model from json
+    save_npz   save_model in .npz          load_npz   load_model from .npz
+
+Results are saved in a json file and can be compared with a previous run:
+    python benchmarks/run_benchmarks.py --sizes 50 200 1000 --output new.json --compare old.json
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+import pandas as pd
+import synthetic
+from imaris import xls_cache, xls_reader
+from imaris.build_model import build_research_data, save_model, load_model
+from imaris.schema import get_schema
+
+
+def _time(function, repeat:int)-> float:
+    """
+    :param function: called without argument
+    :param repeat int: number of calls
+    :return float: best time in seconds
+    """
+    best = None
+    for _ in range(repeat):
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            function()
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def _parse(intensity_file:str, volume_file:str)-> (dict, dict):
+    schema = get_schema()
+    with xls_reader.Workbook(intensity_file) as intensity_workbook:
+        intensity_sheets = intensity_workbook.read_plan(schema.plan("intensity"))
+    with xls_reader.Workbook(volume_file) as volume_workbook:
+        volume_data = volume_workbook.read_plan(schema.plan("volume"))
+    intensity_data = {"Position": intensity_sheets["Position"], "Volume": intensity_sheets["Volume"]}
+    intensity_data.update({channel.name: intensity_sheets[channel.sum_sheet] for channel in schema.channels})
+    return intensity_data, volume_data
+
+def _match(intensity_data:dict, volume_data:dict):
+    neurons = xls_reader.match_neurons(intensity_data, volume_data)
+    for channel in get_schema().channel_names():
+        xls_reader.get_membrane_data(channel=channel, intensity_data=intensity_data, volume_data=volume_data,
+                                     neurons=neurons)
+
+def run(sizes:list, pairs:int, near_duplicates:int, jitter:float, repeat:int, seed:int)-> list:
+    """
+    :param sizes list: numbers of neurons per file
+    :param pairs int: number of file pairs of the dataset used by the build benchmark
+    :param near_duplicates int: number of near-duplicate neurons per volume file
+    :param jitter float: position difference between the two files
+    :param repeat int: number of runs of each benchmark (the best time is kept)
+    :param seed int: random seed of the synthetic files
+    :return list: one dictionary per size and stage
+    """
+    xls_cache.disable_cache()
+    results = []
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as folder:
+            files = synthetic.generate_dataset(folder, pairs=pairs, neurons=size, jitter=jitter,
+                                               near_duplicates=near_duplicates, seed=seed)
+            intensity_file, volume_file = files[0]
+            intensity_data, volume_data = _parse(intensity_file, volume_file)
+            model_json = os.path.join(folder, "model.json")
+            model_npz = os.path.join(folder, "model.npz")
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                research = build_research_data(os.path.join(folder, "intensity"), os.path.join(folder, "intra"),
+                                               name=model_json)
+            timings = {
+                "parse": _time(lambda: _parse(intensity_file, volume_file), repeat),
+                "match": _time(lambda: _match(intensity_data, volume_data), repeat),
+                "build": _time(lambda: build_research_data(os.path.join(folder, "intensity"),
+                                                           os.path.join(folder, "intra"), name=model_json), repeat),
+                "save_json": _time(lambda: save_model(research, model_json), repeat),
+                "load_json": _time(lambda: load_model(model_json), repeat),
+                "save_npz": _time(lambda: save_model(research, model_npz), repeat),
+                "load_npz": _time(lambda: load_model(model_npz), repeat),
+            }
+        for stage, seconds in timings.items():
+            results.append({"neurons": size, "pairs": pairs, "stage": stage, "seconds": seconds})
+            print("{:>8} neurons  {:<10} {:10.4f} s".format(size, stage, seconds))
+    return results
+
+def compare(results:list, previous:list):
+    """
+    Print the ratio new time / previous time of each benchmark found in both runs
+    :param results list: new results
+    :param previous list: results of a previous run
+    :return: None
+    """
+    previous = {(result["neurons"], result["pairs"], result["stage"]): result["seconds"] for result in previous}
+    for result in results:
+        old = previous.get((result["neurons"], result["pairs"], result["stage"]))
+        if old:
+            print("{:>8} neurons  {:<10} {:10.4f} s -> {:10.4f} s  x{:.2f}".format(
+                result["neurons"], result["stage"], old, result["seconds"], result["seconds"] / old))
+
+def main(argv:list=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the excel reader and of the model")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 200, 1000], help="neurons per file")
+    parser.add_argument("--pairs", type=int, default=4, help="file pairs for the build benchmark")
+    parser.add_argument("--near-duplicates", type=int, default=0, help="near-duplicate neurons per volume file")
+    parser.add_argument("--jitter", type=float, default=0.3, help="position difference between the two files")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each benchmark, the best time is kept")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the synthetic files")
+    parser.add_argument("--output", default="benchmark_results.json", help="json file to save the results in")
+    parser.add_argument("--compare", default=None, help="json file of a previous run")
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.pairs, args.near_duplicates, args.jitter, args.repeat, args.seed)
+    with open(args.output, "w") as outfile:
+        json.dump({"settings": vars(args),
+                   "environment": {"python": platform.python_version(), "numpy": np.__version__,
+                                   "pandas": pd.__version__, "machine": platform.machine(),
+                                   "date": time.strftime("%Y-%m-%d %H:%M:%S")},
+                   "results": results}, outfile, indent=4, separators=(',', ': '))
+    if args.compare is not None:
+        with open(args.compare) as infile:
+            compare(results, json.load(infile)["results"])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Generator of synthetic IMARIS workbooks
+
+Writes pairs of .xls files following the naming convention drug_sex_animal_section_neuron_disease_type.xls and the
+layout of the IMARIS exports: a title on the first row, the column names on the second row, and the tabs
+"Position", "Volume", "Intensity Sum Ch=9..16 Img=1" and "Intensity Mean Ch=9..16 Img=1" (intensity file only).
+
+The volume file contains the same neurons as the intensity file, with other IDs and slightly moved (jitter), plus
+optional near-duplicates (neurons very close to an existing one) that make the matching ambiguous.
+
+Requires xlwt (pip install xlwt), only used to write the .xls files.
+"""
+
+import os
+import numpy as np
+
+channels = list(range(9, 17))
+"""channel numbers of the intensity tabs"""
+
+position_header = ["Position X", "Position Y", "Position Z", "Unit", "Category", "Collection", "Time", "ID"]
+volume_header = ["Volume", "Unit", "Category", "Time", "ID"]
+intensity_header = ["{}", "Unit", "Category", "Channel", "Image", "Time", "ID"]
+"""columns of the IMARIS tabs, {} is replaced by "Intensity Sum" or "Intensity Mean" """
+
+
+def _write_workbook(path:str, sheets:dict):
+    """
+    :param path str: .xls file path
+    :param sheets dict: tab name -> (header list, list of columns)
+    :return: None
+    """
+    import xlwt
+    workbook = xlwt.Workbook()
+    for name, (header, columns) in sheets.items():
+        sheet = workbook.add_sheet(name)
+        sheet.write(0, 0, name)
+        for column, title in enumerate(header):
+            sheet.write(1, column, title)
+        for column, values in enumerate(columns):
+            for row, value in enumerate(values):
+                sheet.write(row + 2, column, value.item() if isinstance(value, np.generic) else value)
+    workbook.save(path)
+
+def _position_sheet(positions:np.ndarray, ids:np.ndarray)-> tuple:
+    count = len(ids)
+    return position_header, [positions[:, 0], positions[:, 1], positions[:, 2], ["um"] * count,
+                             ["Surface"] * count, ["Position"] * count, [1] * count, ids]
+
+def _volume_sheet(volumes:np.ndarray, ids:np.ndarray)-> tuple:
+    count = len(ids)
+    return volume_header, [volumes, ["um^3"] * count, ["Surface"] * count, [1] * count, ids]
+
+def generate_pair(folder:str, name:str, neurons:int=50, jitter:float=0.3, near_duplicates:int=0,
+                  seed:int=0)-> (str, str):
+    """
+    Write an intensity file in folder/intensity and the corresponding volume file in folder/intra
+    :param folder str: output folder
+    :param name str: file name without the type, e.g. "d_f_2_1_e_c"
+    :param neurons int: number of neurons
+    :param jitter float: standard deviation of the position difference between the two files
+    :param near_duplicates int: number of extra neurons in the volume file close to an existing neuron
+    :param seed int: random seed, the same seed generates the same files
+    :return (str, str): intensity file path and volume file path
+    """
+    rng = np.random.default_rng(seed)
+    positions = rng.uniform(5, 1000, size=(neurons, 3))
+    ids = np.arange(neurons)
+    total_volumes = rng.uniform(200, 1000, size=neurons)
+
+    intensity_sheets = {"Position": _position_sheet(positions, ids),
+                        "Volume": _volume_sheet(total_volumes, ids)}
+    for measure in ["Sum", "Mean"]:
+        for channel in channels:
+            title = "Intensity " + measure
+            values = rng.uniform(0, 1e5 if measure == "Sum" else 200, size=neurons)
+            header = [column.format(title) for column in intensity_header]
+            intensity_sheets[title + " Ch=" + str(channel) + " Img=1"] = (
+                header, [values, [""] * neurons, ["Surface"] * neurons, [channel] * neurons, [1] * neurons,
+                         [1] * neurons, ids])
+
+    volume_positions = positions + rng.normal(0, jitter, size=positions.shape)
+    if near_duplicates:
+        origins = rng.integers(0, neurons, size=near_duplicates)
+        duplicates = positions[origins] + rng.normal(0, jitter, size=(near_duplicates, 3))
+        volume_positions = np.concatenate([volume_positions, duplicates])
+    volume_ids = np.arange(len(volume_positions)) + 10 * neurons + 1000
+    """IDs differ between the two files"""
+    intra_volumes = np.concatenate([total_volumes * rng.uniform(0.3, 0.9, size=neurons),
+                                    rng.uniform(50, 300, size=len(volume_positions) - neurons)])
+    order = rng.permutation(len(volume_positions))
+    volume_sheets = {"Position": _position_sheet(volume_positions[order], volume_ids),
+                     "Volume": _volume_sheet(intra_volumes[order], volume_ids)}
+
+    os.makedirs(os.path.join(folder, "intensity"), exist_ok=True)
+    os.makedirs(os.path.join(folder, "intra"), exist_ok=True)
+    intensity_file = os.path.join(folder, "intensity", name + "_i.xls")
+    volume_file = os.path.join(folder, "intra", name + "_v.xls")
+    _write_workbook(intensity_file, intensity_sheets)
+    _write_workbook(volume_file, volume_sheets)
+    return intensity_file, volume_file
+
+def get_names(pairs:int)-> list:
+    """
+    :param pairs int: number of file pairs
+    :return list: distinct file names (without type) following the naming convention
+    """
+    names = []
+    for animal in range(1, pairs + 1):
+        for disease in ["c", "i"]:
+            names.append("_".join(["d" if animal % 2 else "n", "f" if animal % 4 < 2 else "m", str(animal), "1",
+                                   "e" if animal % 3 else "i", disease]))
+            if len(names) == pairs:
+                return names
+    return names
+
+def generate_dataset(folder:str, pairs:int=4, neurons:int=50, jitter:float=0.3, near_duplicates:int=0,
+                     seed:int=0)-> list:
+    """
+    Write several file pairs (contra and ipsi for each animal)
+    :param folder str: output folder
+    :param pairs int: number of file pairs
+    :param neurons int: number of neurons per file
+    :param jitter float: standard deviation of the position difference between the two files
+    :param near_duplicates int: number of extra neurons close to an existing neuron in each volume file
+    :param seed int: random seed
+    :return list: (intensity file, volume file) pairs
+    """
+    return [generate_pair(folder, name, neurons=neurons, jitter=jitter, near_duplicates=near_duplicates,
+                          seed=seed + index)
+            for index, name in enumerate(get_names(pairs))]
@@ -0,0 +1,6 @@
+"""python -m imaris, see cli"""
+
+import sys
+from .cli import main
+
+sys.exit(main())
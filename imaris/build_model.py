@@ -1,62 +1,326 @@
-from xls_reader import read_xls, get_info, read_xls_intensity_mean
-from model import ResearchData
+from . import xls_reader
+from .xls_reader import read_xls, read_xls_intensity_mean, Workbook
+from .model import ResearchData, _from_dict_to_research_data
+from .xls_cache import enable_cache, disable_cache, get_cache, _replace
+from .columnar import ColumnarResearchData
+from .normalization import ContraBaseline, normalize_research_data, save_baseline, load_baseline
+from . import instrumentation
+from .instrumentation import RunReport, start_report, stop_report, get_report
+from .prefetch import prefetch_pairs
+from .schema import get_schema
+from .pairing import list_files, index_files, pair_files, get_pairs
 """this is the model in which all experimental data will be stored"""
 
+import os
 import json
-import glob
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 
 
+def save_model(research:ResearchData,name:str="model.json"):
+    """
+    Save the model, in the binary columnar format (see columnar) if name ends with .npz, in json otherwise
+    :param research ResearchData: the data object (or ColumnarResearchData)
+    :param name str: file path
+    :return: None
+    """
+    if name.endswith(".npz"):
+        if not isinstance(research, ColumnarResearchData):
+            research = ColumnarResearchData.from_points(research)
+        research.save(name)
+        return
+    def write(path):
+        with open(path, "w") as outfile:
+            json.dump(research.to_json(), outfile, indent=4, separators=(',', ': '))
+    _replace(name, write)
+    """the file is replaced atomically, readers never see a partially written model"""
 
-def get_intra_equivalent(info:list, intra_files)->str:
+def load_model(name:str="model.json", lazy:bool=False):
     """
-    finds the equivalent intra file based on volume file info
-    :param info list: information regarding the volume file
-    :param intra_files list: of all files containing intracellular data
-    :return str: the corresponding intracellular file path
+    re-build the research data object saved by save_model
+    :param name str: path to the json or .npz file
+    :param lazy bool: for .npz files, return the memory-mapped ColumnarResearchData, data points are only built
+    when accessed (e.g. with select, which returns a ResearchData). ColumnarResearchData has no group_by nor
+    aggregate.
+    :return: ResearchData, or ColumnarResearchData when lazy
+    :raise ValueError: if lazy is True for a json model (json files cannot be memory-mapped)
     """
-    for file in intra_files:
-        intra_info = get_info(file)
-        if intra_info[:-1] == info[:-1]:
-            """the corresponding file will have all the same attributes except for the last one (volume vs intensity)"""
-            return file
+    if lazy and not name.endswith(".npz"):
+        raise ValueError("only .npz models can be loaded lazily, not " + name)
+    if name.endswith(".npz"):
+        if lazy:
+            return ColumnarResearchData.load(name, mmap=True)
+        return ColumnarResearchData.load(name).to_research_data()
+    with open(name) as infile:
+        return _from_dict_to_research_data(json.load(infile))
 
-def save_model(research:ResearchData,name:str="model.json"):
-    with open(name, "w") as outfile:
-        json.dump(research.to_json(), outfile, indent=4, separators=(',', ': '))
+def get_source(intensity_file:str, intra_file:str, schema=None, settings:dict=None)-> dict:
+    """
+    Describe the inputs of a file pair. Data points with the same source do not need to be computed again.
+    :param intensity_file str: intensity file path
+    :param intra_file str: the corresponding intracellular (volume) file path
+    :param schema: Schema or name of a registered schema the files are read with, the default schema if None
+    :param settings dict: thresholds and matching strategy the files are read with (see xls_reader.get_settings),
+    the xls_reader module variables if None
+    :return dict: paths, sizes and modification times of both files, the schema name and the matching thresholds and
+    strategy
+    """
+    if settings is None:
+        settings = xls_reader.get_settings()
+    intensity_stat = os.stat(intensity_file)
+    intra_stat = os.stat(intra_file)
+    source = {"intensity_file": intensity_file,
+              "intensity_size": intensity_stat.st_size,
+              "intensity_mtime": intensity_stat.st_mtime_ns,
+              "volume_file": intra_file,
+              "volume_size": intra_stat.st_size,
+              "volume_mtime": intra_stat.st_mtime_ns,
+              "schema": get_schema(schema).name}
+    source.update(settings)
+    return source
 
 
-def build_research_data(intensity_path:str,intra_path:str):
+def read_pairs(pairs:list, prefetch:int=0, schema=None, settings:dict=None):
     """
-    Create a python model based on the excel files
+    Read the file pairs one at a time, in order
+    :param pairs list: (intensity file, intra file) pairs
+    :param prefetch int: number of pairs whose files are read in background threads while the current pair is
+    processed (see prefetch), 0 reads each file when it is processed
+    :param schema: Schema or name of a registered schema, the default schema if None
+    :param settings dict: thresholds and matching strategy (see xls_reader.get_settings), the module variables if None
+    :return generator: ((intensity file, intra file), data points) for each pair
+    """
+    if prefetch <= 0:
+        for intensity_file, intra_file in pairs:
+            yield (intensity_file, intra_file), read_xls(intensity_file=intensity_file,volume_file=intra_file,
+                                                         schema=schema, settings=settings)
+        return
+    cache = get_cache()
+    skip = None
+    if cache is not None:
+        intensity_plan = get_schema(schema).plan("intensity")
+        volume_plan = get_schema(schema).plan("volume")
+        plans = {path: plan for pair in pairs for path, plan in zip(pair, [intensity_plan, volume_plan])}
+        """file path -> ParsePlan the file is read with"""
+        skip = lambda path: cache.contains(path, plans[path].sheets, plans[path].header, plans[path].dtype)
+        """files whose tabs are all cached are not read, Workbook only opens them if a tab is missing"""
+    for intensity_file, intra_file, intensity_bytes, intra_bytes in prefetch_pairs(pairs, depth=prefetch, skip=skip):
+        with Workbook(intensity_file, intensity_bytes) as intensity_workbook, \
+                Workbook(intra_file, intra_bytes) as intra_workbook:
+            yield (intensity_file, intra_file), read_xls(intensity_file=intensity_workbook,
+                                                         volume_file=intra_workbook, schema=schema,
+                                                         settings=settings)
+
+def iter_research_points(intensity_path:str,intra_path:str,prefetch:int=0,schema=None):
+    """
+    Read the file pairs one at a time, without keeping the data points in memory (e.g. for export.write_graphpad_csv)
     :param intensity_path str: path to the intensity folder
     :param intra_path str: path to the intra (or volume) folder
+    :param prefetch int: number of pairs read ahead in background threads (see read_pairs)
+    :param schema: Schema or name of a registered schema, the default schema if None
+    :return generator: the data points of each file pair
+    """
+    settings = xls_reader.get_settings()
+    pairs = get_pairs(intensity_path, intra_path, schema)
+    for (intensity_file, intra_file), new_points in read_pairs(pairs, prefetch, schema, settings):
+        source = get_source(intensity_file, intra_file, schema, settings)
+        for point in new_points:
+            point.source = source
+            yield point
+
+_instrumented = False
+"""if the worker process records a run report for each file pair"""
+
+def _init_worker(cache_dir:str, instrumented:bool=False):
+    """
+    Initialize a worker process of build_research_data
+    :param cache_dir str: folder caching the parsed sheets, no cache if None
+    :param instrumented bool: record a run report for each file pair
     :return: None
     """
+    global _instrumented
+    if cache_dir is not None:
+        enable_cache(cache_dir)
+    else:
+        disable_cache()
+        """a forked worker inherits the cache of its parent"""
+    _instrumented = instrumented
+
+def _process_pair(intensity_file:str, intra_file:str, schema=None, settings:dict=None)-> (list,dict,str):
+    """
+    Read one intensity/volume file pair. Runs in a worker process when build_research_data is called with workers > 1.
+    :param intensity_file str: intensity file path
+    :param intra_file str: the corresponding intracellular (volume) file path
+    :param schema Schema: schema the files are read with
+    :param settings dict: thresholds and matching strategy of the caller (the module variables of the worker process
+    are the defaults when it is spawned)
+    :return (list,dict,str): the data points, the run report of the pair (RunReport.to_json(), None if not
+    instrumented) and the error (None on success)
+    """
+    if _instrumented:
+        start_report()
+    try:
+        new_points = read_xls(intensity_file=intensity_file,volume_file=intra_file,schema=schema,settings=settings)
+        error = None
+    except Exception:
+        new_points = []
+        error = traceback.format_exc()
+    report = stop_report()
+    return new_points, report.to_json() if report is not None else None, error
+
+
+def build_research_data(intensity_path:str,intra_path:str,workers:int=1,cache_dir:str=None,
+                        incremental:bool=False,name:str="model.json",normalized_name:str=None,
+                        report:RunReport=None,prefetch:int=0,schema=None,settings:dict=None)-> ResearchData:
+    """
+    Create a python model based on the excel files
+    :param intensity_path str: path to the intensity folder
+    :param intra_path str: path to the intra (or volume) folder
+    :param workers int: number of processes reading the file pairs (1 reads them in the current process)
+    :param cache_dir str: folder caching the parsed sheets between runs (see xls_cache), no cache if None (even if one
+    was enabled before)
+    :param incremental bool: reuse the data points of the saved model whose file pair and thresholds did not change,
+    points of deleted files are dropped
+    :param name str: path to the json (or .npz) file the model is saved in (and loaded from when incremental)
+    :param normalized_name str: path to save the ipsi data points normalized by their contra baseline (see
+    normalization), not normalized if None. The baselines are saved next to the model (see get_baseline_name), when
+    incremental they are only updated with the file pairs processed again.
+    :param report RunReport: report recording the timings, matching outcomes and errors of the run (see
+    instrumentation), the report already started with start_report is used if None
+    :param prefetch int: when workers is 1, number of file pairs read ahead in background threads while the current
+    pair is matched (hides the latency of remote storage), 0 reads each file when it is processed
+    :param schema: Schema or name of a registered schema describing the files (see schema), the default schema if None
+    :param settings dict: thresholds and matching strategy (see xls_reader.get_settings), the xls_reader module
+    variables at the time of the call if None
+    :return ResearchData: the model, also saved in name
+    """
+    if report is not None:
+        start_report(report)
+    try:
+        with instrumentation.stage("build"):
+            return _build_research_data(intensity_path, intra_path, workers, cache_dir, incremental, name,
+                                        normalized_name, prefetch, get_schema(schema),
+                                        settings if settings is not None else xls_reader.get_settings())
+    finally:
+        if report is not None:
+            stop_report()
+
+def _build_research_data(intensity_path:str,intra_path:str,workers:int,cache_dir:str,incremental:bool,name:str,
+                         normalized_name:str,prefetch:int,schema,settings:dict)-> ResearchData:
     model = ResearchData()
+    if cache_dir is not None:
+        enable_cache(cache_dir)
+    else:
+        disable_cache()
+        """a cache enabled by an earlier call is not used"""
+
+    with instrumentation.stage("pairing"):
+        pairs = get_pairs(intensity_path, intra_path, schema)
+
+    sources = {pair: get_source(*pair, schema=schema, settings=settings) for pair in pairs}
+    points = {}
+    """file pair -> data points"""
+    previous_sources = {}
+    """file pair -> source, in the saved model"""
+    dropped = []
+    """contra data points of the saved model whose source changed or was deleted"""
+    if incremental and os.path.exists(name):
+        for point in load_model(name):
+            if point.source is None:
+                previous_sources = None
+                continue
+            pair = (point.source["intensity_file"], point.source["volume_file"])
+            if previous_sources is not None:
+                previous_sources[pair] = point.source
+            if sources.get(pair) == point.source:
+                points.setdefault(pair, []).append(point)
+            elif point.disease == "contra":
+                dropped.append(point)
+        """points whose source changed or was deleted are dropped"""
+    to_process = [pair for pair in pairs if pair not in points]
 
-    intra_files = glob.glob(intra_path+"/*.xls")
-    for intensity_file in glob.glob(intensity_path+"/*.xls"):
-        intensity_info = get_info(intensity_file)
-        intra_file = get_intra_equivalent(intensity_info,intra_files)
-        if intra_file is not None:
-            new_points = read_xls(intensity_file=intensity_file,volume_file=intra_file)
-            [model.add_data(point) for point in new_points]
-        else:
-            print("ERROR could not find intra equivalent for", intensity_file)
+    errors = []
+    if workers > 1:
+        instrumented = get_report() is not None
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(cache_dir, instrumented)) as executor:
+            results = executor.map(_process_pair, *zip(*to_process), [schema] * len(to_process),
+                                   [settings] * len(to_process)) if to_process else []
+            """map keeps the order of the pairs whatever the order in which the workers finish"""
+            for (intensity_file, intra_file), (new_points, pair_report, error) in zip(to_process, results):
+                if pair_report is not None:
+                    get_report().merge(pair_report)
+                if error is not None:
+                    instrumentation.error("read_error", file=intensity_file, volume_file=intra_file, traceback=error)
+                    errors.append((intensity_file, intra_file, error))
+                points[(intensity_file, intra_file)] = new_points
+    else:
+        for pair, new_points in read_pairs(to_process, prefetch, schema, settings):
+            points[pair] = new_points
 
+    """errors from the workers are gathered and raised once all the pairs are processed"""
+    if errors:
+        raise RuntimeError("could not read " + str(len(errors)) + " file pair(s):\n" +
+                           "\n".join(intensity_file + " and " + intra_file + "\n" + error
+                                     for intensity_file, intra_file, error in errors))
 
-    save_model(model)
+    for pair in pairs:
+        for point in points.get(pair, []):
+            point.source = sources[pair]
+            model.add_data(point)
+
+    with instrumentation.stage("save", name):
+        save_model(model, name)
     """saves the model in a json format that can then be reloaded for further analysis"""
+    if normalized_name is not None:
+        with instrumentation.stage("normalize"):
+            baseline, baseline_sources = load_baseline(get_baseline_name(name)) if incremental else (None, None)
+            if baseline is not None and previous_sources == {(source["intensity_file"], source["volume_file"]): source
+                                                             for source in baseline_sources}:
+                for point in dropped:
+                    baseline.remove(point)
+                for pair in to_process:
+                    for point in points.get(pair, []):
+                        baseline.add(point)
+                """only the file pairs processed again change the baselines"""
+            else:
+                baseline = ContraBaseline()
+                baseline.add_research_data(model)
+            normalized = normalize_research_data(model, baseline)
+        save_model(normalized, normalized_name)
+        save_baseline(baseline, get_baseline_name(name), [sources[pair] for pair in pairs])
+    return model
+
+def get_baseline_name(name:str)-> str:
+    """
+    :param name str: path of the model
+    :return str: path of the contra baselines of the model (see normalization.save_baseline), e.g. model.baseline.json
+    for model.json
+    """
+    return os.path.splitext(name)[0] + ".baseline.json"
 
-def build_research_intensity_mean_data(intensity_path:str):
+def build_research_intensity_mean_data(intensity_path:str,cache_dir:str=None,schema=None,
+                                       name:str="model.json")-> ResearchData:
     """
     Build the resarch model for intensity mean only, no volume files
     :param intensity_path: path to the intensity folder
-    :return:
+    :param cache_dir str: folder caching the parsed sheets between runs (see xls_cache), no cache if None (even if one
+    was enabled before)
+    :param schema: Schema or name of a registered schema describing the files (see schema), the default schema if None
+    :param name str: path to the json (or .npz) file the model is saved in
+    :return ResearchData: the model, also saved in name
     """
     model = ResearchData()
-    for intensity_file in glob.glob(intensity_path+"/*.xls"):
-        intensity_info = get_info(intensity_file)
-        new_points = read_xls_intensity_mean(intensity_file=intensity_file)
+    if cache_dir is not None:
+        enable_cache(cache_dir)
+    else:
+        disable_cache()
+        """a cache enabled by an earlier call is not used"""
+    intensity_files = list_files(intensity_path)
+    index_files(intensity_files, schema, "intensity")
+    """fails fast on malformed file names"""
+    for intensity_file in intensity_files:
+        new_points = read_xls_intensity_mean(intensity_file=intensity_file, schema=schema)
         [model.add_data(point) for point in new_points]
-    save_model(model)
+    save_model(model, name)
+    return model
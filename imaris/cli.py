@@ -0,0 +1,243 @@
+"""Command line interface
+
+    python -m imaris build INTENSITY_FOLDER INTRA_FOLDER [--name model.json] [--workers 4] [--cache-dir cache] ...
+    python -m imaris build-mean INTENSITY_FOLDER [--name model.json]
+    python -m imaris export MODEL CSV [--value intensity] [--group-fields sex layer]
+    python -m imaris validate INTENSITY_FOLDER INTRA_FOLDER [--no-sheets]
+    python -m imaris validate INTENSITY_FOLDER --mean
+
+validate checks the file names, the pairing and the presence of the tabs without parsing the data, e.g. before
+submitting a batch job.
+
+The modules using numpy and pandas are only imported by the commands that need them, so that validate and --help
+start quickly.
+
+Exit status: 0 on success, 1 if the files are invalid or the command failed, 2 on a command line error.
+"""
+
+import argparse
+import logging
+import os
+import sys
+
+EXIT_OK = 0
+EXIT_FAILURE = 1
+"""invalid files, or error while running the command"""
+EXIT_USAGE = 2
+"""command line error (the exit status of argparse)"""
+
+group_fields = ["drug", "sex", "animal", "section", "neuron", "layer", "disease", "location"]
+"""fields the export columns can be defined by (model.query_fields), not imported so that the model (and pandas) is
+only loaded by the commands using it"""
+
+
+def _get_schema(schema:str):
+    """
+    :param schema str: name of a registered schema, path to a schema json file, or None for the default schema
+    :return Schema: the schema
+    """
+    from .schema import get_schema, load_schema
+    if schema is not None and schema.endswith(".json"):
+        return load_schema(schema)
+    return get_schema(schema)
+
+def _sheet_names(file:str)-> set:
+    """
+    :param file str: .xls file path
+    :return set: names of the tabs, read without loading the tabs
+    """
+    import xlrd
+    book = xlrd.open_workbook(file, on_demand=True)
+    try:
+        return set(book.sheet_names())
+    finally:
+        book.release_resources()
+
+def _check_files(files:list, file_type:str, schema, problems:list)-> dict:
+    """
+    :param files list: Excel file paths of a folder
+    :param file_type str: type of the files of the folder ("intensity" or "volume")
+    :param schema Schema: naming convention
+    :param problems list: the problems found are appended
+    :return dict: identifier tuple -> file path of the valid files
+    """
+    from .pairing import get_info, index_files
+    valid = []
+    for file in files:
+        info = get_info(file)
+        try:
+            schema.check_info(info, file, file_type)
+        except ValueError as error:
+            problems.append(str(error))
+            continue
+        valid.append(file)
+    index, duplicates = index_files(valid, schema, file_type)
+    for duplicated in duplicates.values():
+        problems.append("duplicated identifiers: " + ", ".join(duplicated))
+    return index
+
+def _check_sheets(file:str, sheets:list, problems:list):
+    """
+    :param file str: Excel file path
+    :param sheets list: names of the tabs read from the file
+    :param problems list: the problems found are appended
+    :return: None
+    """
+    try:
+        names = _sheet_names(file)
+    except Exception as error:
+        problems.append("cannot open " + file + ": " + str(error))
+        return
+    missing = [sheet for sheet in sheets if sheet not in names]
+    if missing:
+        problems.append("missing tab(s) in " + file + ": " + ", ".join(missing))
+
+def validate(args)-> int:
+    from .pairing import list_files
+    try:
+        schema = _get_schema(args.schema)
+    except ValueError as error:
+        print(str(error), file=sys.stderr)
+        print("invalid schema, no file checked")
+        return EXIT_FAILURE
+    problems = []
+    intensity_files = list_files(args.intensity)
+    if not intensity_files:
+        problems.append("no .xls file in " + args.intensity)
+    intensity_index = _check_files(intensity_files, "intensity", schema, problems)
+
+    if args.mean:
+        checked = [(file, schema.plan("intensity_mean").sheets) for file in intensity_index.values()]
+    else:
+        if args.intra is None:
+            print("error: the intra folder is required unless --mean is given", file=sys.stderr)
+            return EXIT_USAGE
+        intra_files = list_files(args.intra)
+        if not intra_files:
+            problems.append("no .xls file in " + args.intra)
+        intra_index = _check_files(intra_files, "volume", schema, problems)
+        for key, file in intensity_index.items():
+            if key not in intra_index:
+                problems.append("could not find intra equivalent for " + file)
+        for key, file in intra_index.items():
+            if key not in intensity_index:
+                problems.append("could not find intensity equivalent for " + file)
+        checked = []
+        for key in intensity_index:
+            if key in intra_index:
+                checked.append((intensity_index[key], schema.plan("intensity").sheets))
+                checked.append((intra_index[key], schema.plan("volume").sheets))
+
+    if not args.no_sheets:
+        for file, sheets in checked:
+            _check_sheets(file, list(sheets), problems)
+
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    print(str(len(checked)) + " file(s) to read, " + str(len(problems)) + " problem(s)")
+    return EXIT_FAILURE if problems else EXIT_OK
+
+def build(args)-> int:
+    from . import xls_reader
+    from .build_model import build_research_data
+    from .instrumentation import RunReport
+    schema = _get_schema(args.schema)
+    if args.store is not None and args.cohort is None:
+        print("error: --cohort is required with --store", file=sys.stderr)
+        return EXIT_USAGE
+    settings = xls_reader.get_settings(matching_strategy=args.strategy)
+    report = RunReport() if args.report is not None else None
+    research = build_research_data(args.intensity, args.intra, workers=args.workers, cache_dir=args.cache_dir,
+                                   incremental=args.incremental, name=args.name,
+                                   normalized_name=args.normalized_name, report=report, prefetch=args.prefetch,
+                                   schema=schema, settings=settings)
+    if report is not None:
+        report.save(args.report)
+    if args.store is not None:
+        from .store import ResearchStore
+        with ResearchStore(args.store) as store:
+            store.ingest(research, args.cohort)
+    print(str(len(research)) + " data point(s) saved in " + args.name)
+    return EXIT_OK
+
+def build_mean(args)-> int:
+    from .build_model import build_research_intensity_mean_data
+    research = build_research_intensity_mean_data(args.intensity, cache_dir=args.cache_dir,
+                                                  schema=_get_schema(args.schema), name=args.name)
+    print(str(len(research)) + " data point(s) saved in " + args.name)
+    return EXIT_OK
+
+def export(args)-> int:
+    from .build_model import load_model
+    from .export import write_graphpad_csv
+    columns = write_graphpad_csv(load_model(args.model, lazy=args.model.endswith(".npz")), args.csv, group_fields=args.group_fields,
+                                 value=args.value)
+    print(str(len(columns)) + " column(s) written in " + args.csv)
+    return EXIT_OK
+
+def get_parser()-> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="imaris", description="Extract and analyze data from IMARIS computation")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log the progress of the analysis")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+
+    schema_help = "name of a registered schema or path to a schema json file (default: kcc2)"
+
+    command = commands.add_parser("build", help="match the intensity and volume files and save the model")
+    command.add_argument("intensity", help="intensity folder")
+    command.add_argument("intra", help="intra (or volume) folder")
+    command.add_argument("--name", default="model.json", help="model file, .json or .npz (default: model.json)")
+    command.add_argument("--workers", type=int, default=1, help="processes reading the file pairs")
+    command.add_argument("--prefetch", type=int, default=0, help="file pairs read ahead (with --workers 1)")
+    command.add_argument("--cache-dir", default=None, help="folder caching the parsed tabs between runs")
+    command.add_argument("--incremental", action="store_true", help="only read the file pairs that changed")
+    command.add_argument("--normalized-name", default=None, help="file to save the normalized ipsi data points in")
+    command.add_argument("--strategy", choices=["unique", "assignment"], default=None, help="matching strategy")
+    command.add_argument("--report", default=None, help="run report file, .json or .csv")
+    command.add_argument("--store", default=None, help="SQLite database the data points are also inserted in")
+    command.add_argument("--cohort", default=None, help="cohort name of the data points in the database")
+    command.add_argument("--schema", default=None, help=schema_help)
+    command.set_defaults(handler=build)
+
+    command = commands.add_parser("build-mean", help="save the intensity mean model (no volume files)")
+    command.add_argument("intensity", help="intensity folder")
+    command.add_argument("--name", default="model.json", help="model file, .json or .npz (default: model.json)")
+    command.add_argument("--cache-dir", default=None, help="folder caching the parsed tabs between runs")
+    command.add_argument("--schema", default=None, help=schema_help)
+    command.set_defaults(handler=build_mean)
+
+    command = commands.add_parser("export", help="write a model in a .csv file formatted for GraphPad")
+    command.add_argument("model", help="model file, .json or .npz")
+    command.add_argument("csv", help=".csv file")
+    command.add_argument("--value", choices=["intensity", "volume"], default="intensity", help="values written")
+    command.add_argument("--group-fields", nargs="+", default=None, choices=group_fields, metavar="FIELD",
+                         help="fields defining the columns, among " + " ".join(group_fields) +
+                              " (default: drug sex neuron disease location layer)")
+    command.set_defaults(handler=export)
+
+    command = commands.add_parser("validate", help="check the file names, the pairing and the tabs, without "
+                                                   "parsing the data")
+    command.add_argument("intensity", help="intensity folder")
+    command.add_argument("intra", nargs="?", default=None, help="intra (or volume) folder")
+    command.add_argument("--mean", action="store_true", help="check the intensity files only (build-mean)")
+    command.add_argument("--no-sheets", action="store_true", help="only check the file names and the pairing")
+    command.add_argument("--schema", default=None, help=schema_help)
+    command.set_defaults(handler=validate)
+    return parser
+
+def main(argv:list=None)-> int:
+    """
+    :param argv list: command line arguments, sys.argv[1:] if None
+    :return int: exit status
+    """
+    args = get_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format="%(levelname)s %(message)s")
+    for folder in [getattr(args, "intensity", None), getattr(args, "intra", None)]:
+        if folder is not None and not os.path.isdir(folder):
+            print("error: " + folder + " is not a folder", file=sys.stderr)
+            return EXIT_FAILURE
+    try:
+        return args.handler(args)
+    except (ValueError, RuntimeError, KeyError, OSError) as error:
+        print("error: " + str(error), file=sys.stderr)
+        return EXIT_FAILURE
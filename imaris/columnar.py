@@ -0,0 +1,270 @@
+"""Columnar storage of the research data
+
+ResearchData keeps one python object (and python lists of floats) per data point. ColumnarResearchData stores the same
+content in a few numpy arrays:
+    - one categorical column (integer codes + list of categories) per metadata field
+    - the volume and intensity values of all the data points concatenated in two float64 arrays, with the offsets of
+      each data point (data point i is values[offsets[i]:offsets[i+1]])
+
+It is saved to and loaded from a binary .npz file, and can be converted back and forth to ResearchData and to the
+json format of save_model.
+
+The .npz file is not compressed so that it can be loaded lazily (load(name, mmap=True)): only the metadata columns are
+read, the measurement arrays are memory-mapped and data points are built when they are accessed. measurements()
+returns views of the map, the data points built by get() hold a copy of their values (IntensityVolumeData stores them
+as array("d")).
+"""
+
+import json
+import struct
+import zipfile
+import numpy as np
+from .model import IntensityVolumeData, ResearchData, _from_dict_to_int_vol
+from .xls_cache import _replace
+
+metadata_fields = ["drug", "sex", "animal", "section", "neuron", "layer", "disease", "location", "source"]
+"""categorical columns, one value per data point"""
+
+value_fields = ["volume", "intensity"]
+"""measurement columns, one array of values per data point"""
+
+
+def _category_key(value):
+    """categories are compared through their json representation (sources are dictionaries)"""
+    return json.dumps(value, sort_keys=True)
+
+def _memmap_npz(name:str)-> dict:
+    """
+    Memory-map the arrays of a non compressed .npz file (np.load ignores mmap_mode for .npz files)
+    :param name str: .npz file path
+    :return dict: array name -> read-only np.memmap (or np.ndarray for empty, object or compressed arrays)
+    """
+    arrays = {}
+    with zipfile.ZipFile(name) as archive, open(name, "rb") as infile:
+        for info in archive.infolist():
+            key = info.filename[:-len(".npy")] if info.filename.endswith(".npy") else info.filename
+            infile.seek(info.header_offset)
+            local_header = infile.read(30)
+            name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+            infile.seek(info.header_offset + 30 + name_length + extra_length)
+            """start of the .npy file in the archive"""
+            version = np.lib.format.read_magic(infile)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(infile)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(infile)
+            if info.compress_type != zipfile.ZIP_STORED or dtype.hasobject or int(np.prod(shape)) == 0:
+                with archive.open(info) as member:
+                    arrays[key] = np.lib.format.read_array(member)
+            else:
+                arrays[key] = np.memmap(name, dtype=dtype, mode="r", offset=infile.tell(), shape=shape,
+                                        order="F" if fortran_order else "C")
+    return arrays
+
+
+class ColumnarResearchData:
+    """
+    Contains all data points of the dataset as numpy columns.
+    """
+    def __init__(self, codes:dict=None, categories:dict=None, values:dict=None, offsets:dict=None):
+        """
+        :param codes dict: metadata field -> int32 array, code of the category of each data point
+        :param categories dict: metadata field -> list of the categories (the values of the field)
+        :param values dict: "volume"/"intensity" -> float64 array of the values of all the data points
+        :param offsets dict: "volume"/"intensity" -> int64 array (length: number of data points + 1)
+        """
+        self._codes = codes if codes is not None else {field: np.zeros(0, dtype=np.int32)
+                                                       for field in metadata_fields}
+        self._categories = categories if categories is not None else {field: [] for field in metadata_fields}
+        self._values = values if values is not None else {field: np.zeros(0) for field in value_fields}
+        self._offsets = offsets if offsets is not None else {field: np.zeros(1, dtype=np.int64)
+                                                             for field in value_fields}
+
+    def __len__(self):
+        return len(self._codes[metadata_fields[0]])
+
+    def codes(self, field:str)-> np.ndarray:
+        """
+        :param field str: metadata field
+        :return np.ndarray: code of the category of each data point
+        """
+        return self._codes[field]
+
+    def categories(self, field:str)-> list:
+        """
+        :param field str: metadata field
+        :return list: the values of the field, indexed by code
+        """
+        return self._categories[field]
+
+    def column(self, field:str)-> np.ndarray:
+        """
+        :param field str: metadata field
+        :return np.ndarray: value of the field for each data point (object array)
+        """
+        categories = np.empty(len(self._categories[field]), dtype=object)
+        categories[:] = self._categories[field]
+        return categories[self._codes[field]]
+
+    def values(self, field:str)-> np.ndarray:
+        """
+        :param field str: "volume" or "intensity"
+        :return np.ndarray: the values of all the data points, concatenated
+        """
+        return self._values[field]
+
+    def offsets(self, field:str)-> np.ndarray:
+        """
+        :param field str: "volume" or "intensity"
+        :return np.ndarray: values of data point i are values(field)[offsets[i]:offsets[i+1]]
+        """
+        return self._offsets[field]
+
+    def measurements(self, field:str, index:int)-> np.ndarray:
+        """
+        :param field str: "volume" or "intensity"
+        :param index int: data point number
+        :return np.ndarray: the values of the data point (a view, not a copy)
+        """
+        offsets = self._offsets[field]
+        return self._values[field][offsets[index]:offsets[index + 1]]
+
+    def get(self, index:int)-> IntensityVolumeData:
+        """
+        :param index int: data point number
+        :return IntensityVolumeData: the data point, its values are copied (use measurements for a view)
+        """
+        point = IntensityVolumeData(**{field: self._categories[field][self._codes[field][index]]
+                                       for field in metadata_fields})
+        point.volume = self.measurements("volume", index)
+        point.intensity = self.measurements("intensity", index)
+        return point
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.get(index)
+
+    def positions(self, **criteria)-> np.ndarray:
+        """
+        Find the data points from the metadata columns only, e.g. positions(sex="male", layer=[1, 2])
+        :param criteria: field=value or field=[values], all criteria must be met
+        :return np.ndarray: the numbers of the matching data points
+        """
+        selected = np.ones(len(self), dtype=bool)
+        for field, accepted in criteria.items():
+            if field not in self._codes:
+                raise KeyError("cannot query on " + field + ", expected one of " + str(metadata_fields))
+            if not isinstance(accepted, (list, tuple, set)):
+                accepted = [accepted]
+            accepted = {_category_key(value) for value in accepted}
+            accepted_codes = [code for code, value in enumerate(self._categories[field])
+                              if _category_key(value) in accepted]
+            selected &= np.isin(self._codes[field], accepted_codes)
+        return np.flatnonzero(selected)
+
+    def select(self, **criteria)-> ResearchData:
+        """
+        Build the data points matching the criteria (only their measurements are read)
+        :param criteria: field=value or field=[values], all criteria must be met
+        :return ResearchData: the matching data points
+        """
+        research = ResearchData()
+        for index in self.positions(**criteria):
+            research.add_data(self.get(index))
+        return research
+
+    @classmethod
+    def from_points(cls, points)-> "ColumnarResearchData":
+        """
+        :param points iterable: IntensityVolumeData objects (ResearchData is iterable)
+        :return ColumnarResearchData: the same data in columns
+        """
+        codes = {field: [] for field in metadata_fields}
+        categories = {field: [] for field in metadata_fields}
+        lookups = {field: {} for field in metadata_fields}
+        values = {field: [] for field in value_fields}
+        lengths = {field: [] for field in value_fields}
+        for point in points:
+            for field in metadata_fields:
+                value = getattr(point, field)
+                key = _category_key(value)
+                code = lookups[field].get(key)
+                if code is None:
+                    code = lookups[field][key] = len(categories[field])
+                    categories[field].append(value)
+                codes[field].append(code)
+            for field in value_fields:
+                measurement = getattr(point, field)
+                values[field].append(np.asarray(measurement, dtype=np.float64))
+                lengths[field].append(len(measurement))
+        offsets = {field: np.concatenate([[0], np.cumsum(lengths[field], dtype=np.int64)]).astype(np.int64)
+                   for field in value_fields}
+        values = {field: np.concatenate(values[field]) if values[field] else np.zeros(0) for field in value_fields}
+        codes = {field: np.asarray(codes[field], dtype=np.int32) for field in metadata_fields}
+        return cls(codes=codes, categories=categories, values=values, offsets=offsets)
+
+    def to_research_data(self)-> ResearchData:
+        """
+        :return ResearchData: one IntensityVolumeData per data point
+        """
+        research = ResearchData()
+        for point in self:
+            research.add_data(point)
+        return research
+
+    def to_json(self)-> dict:
+        """
+        :return dict: same format as ResearchData.to_json
+        """
+        return {index: point.to_json() for index, point in enumerate(self)}
+
+    @classmethod
+    def from_json(cls, dict_obj:dict)-> "ColumnarResearchData":
+        """
+        :param dict_obj dict: originate from ResearchData.to_json() (e.g. a loaded model.json)
+        :return ColumnarResearchData:
+        """
+        return cls.from_points(_from_dict_to_int_vol(dict_obj[key]) for key in dict_obj)
+
+    def save(self, name:str):
+        """
+        Save in a (non compressed) .npz file. The file is replaced atomically: processes that memory-mapped the
+        previous file (load(name, mmap=True)) keep reading it instead of crashing on a truncated file.
+        :param name str: file path
+        :return: None
+        """
+        arrays = {}
+        for field in metadata_fields:
+            arrays["codes_" + field] = self._codes[field]
+        for field in value_fields:
+            arrays["values_" + field] = self._values[field]
+            arrays["offsets_" + field] = self._offsets[field]
+        arrays["categories"] = np.array(json.dumps(self._categories))
+        """categories are few, they are kept as json to preserve their types (bool, int, str, None, dict)"""
+        def write(path):
+            with open(path, "wb") as outfile:
+                np.savez(outfile, **arrays)
+        _replace(name, write)
+
+    @classmethod
+    def load(cls, name:str, mmap:bool=False)-> "ColumnarResearchData":
+        """
+        :param name str: .npz file saved by save
+        :param mmap bool: memory-map the measurement arrays instead of reading them, the values of a data point are
+        only read from the disk when it is accessed (save replaces the file, the mapped version stays readable)
+        :return ColumnarResearchData:
+        """
+        if mmap:
+            stored = _memmap_npz(name)
+            categories = json.loads(str(stored["categories"]))
+            codes = {field: np.array(stored["codes_" + field]) for field in metadata_fields}
+            """the metadata columns are small and used by every query, they are read"""
+            values = {field: stored["values_" + field] for field in value_fields}
+            offsets = {field: stored["offsets_" + field] for field in value_fields}
+            return cls(codes=codes, categories=categories, values=values, offsets=offsets)
+        with np.load(name) as stored:
+            categories = json.loads(str(stored["categories"]))
+            codes = {field: stored["codes_" + field] for field in metadata_fields}
+            values = {field: stored["values_" + field] for field in value_fields}
+            offsets = {field: stored["offsets_" + field] for field in value_fields}
+        return cls(codes=codes, categories=categories, values=values, offsets=offsets)
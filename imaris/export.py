@@ -0,0 +1,90 @@
+"""Export of the data points to a .csv file formatted for GraphPad
+
+One column per group (e.g. per sex, neuron and layer) listing the values of all the neurons of the group. Columns do not
+have the same length (ragged rows).
+
+The values are streamed to one temporary file per group while the data points are read, then the columns are written
+side by side, chunk by chunk: the memory used does not depend on the number of data points.
+"""
+
+import csv
+import os
+import tempfile
+import numpy as np
+from .model import IntensityVolumeData, query_fields
+
+default_group_fields = ["drug", "sex", "neuron", "disease", "location", "layer"]
+"""one column per combination of these fields"""
+
+
+def _iter_points(points):
+    """
+    :param points iterable: data points, or lists of data points (e.g. read_xls results)
+    :return generator: the data points
+    """
+    for item in points:
+        if isinstance(item, IntensityVolumeData):
+            yield item
+        else:
+            yield from item
+
+def _sort_key(key:tuple)-> list:
+    """columns are sorted on the values of the fields (layer 2 before layer 10), None values first"""
+    return [(field_value is not None, type(field_value).__name__, field_value if field_value is not None else 0)
+            for field_value in key]
+
+def get_column_name(group_fields:list, key:tuple)-> str:
+    """
+    :param group_fields list: fields defining the groups
+    :param key tuple: values of the fields
+    :return str: name of the column, e.g. "sex=male layer=1"
+    """
+    return " ".join(field + "=" + str(value) for field, value in zip(group_fields, key))
+
+def write_graphpad_csv(points, name:str, group_fields:list=None, value:str="intensity", chunk_size:int=4096)-> list:
+    """
+    Write the values of the data points in a .csv file, one column per group
+    :param points iterable: ResearchData, data points or lists of data points (e.g. a generator of read_xls results)
+    :param name str: path to the .csv file
+    :param group_fields list: fields defining the columns (default_group_fields if None)
+    :param value str: "intensity" or "volume"
+    :param chunk_size int: number of rows written at once
+    :return list: names of the columns
+    :raise ValueError: if a group field or the value is unknown
+    """
+    if group_fields is None:
+        group_fields = default_group_fields
+    for field in group_fields:
+        if field not in query_fields:
+            raise ValueError("cannot group on " + str(field) + ", expected one of " + str(query_fields))
+    if value not in ["intensity", "volume"]:
+        raise ValueError("value should be intensity or volume, not " + str(value))
+    with tempfile.TemporaryDirectory() as spool_dir:
+        spools = {}
+        """group key -> temporary file of the group values (float64)"""
+        try:
+            for point in _iter_points(points):
+                key = tuple(getattr(point, field) for field in group_fields)
+                spool = spools.get(key)
+                if spool is None:
+                    spool = spools[key] = open(os.path.join(spool_dir, str(len(spools))), "w+b")
+                spool.write(np.asarray(getattr(point, value), dtype=np.float64).tobytes())
+
+            keys = sorted(spools, key=_sort_key)
+            columns = [get_column_name(group_fields, key) for key in keys]
+            with open(name, "w", newline="") as outfile:
+                writer = csv.writer(outfile)
+                writer.writerow(columns)
+                for key in keys:
+                    spools[key].seek(0)
+                while True:
+                    chunks = [np.fromfile(spools[key], dtype=np.float64, count=chunk_size) for key in keys]
+                    rows = max((len(chunk) for chunk in chunks), default=0)
+                    if rows == 0:
+                        break
+                    for row in range(rows):
+                        writer.writerow([repr(float(chunk[row])) if row < len(chunk) else "" for chunk in chunks])
+        finally:
+            for spool in spools.values():
+                spool.close()
+    return columns
@@ -0,0 +1,212 @@
+"""Instrumentation of the analysis
+
+A RunReport records:
+    - the time spent in each stage (open, parse, match, build...) for each file
+    - the matching outcome counters (matched, no match, ambiguous, negative volume...) for each file and channel
+    - structured error records (one dictionary per error)
+and is saved as json (or csv tables) at the end of the run.
+
+The module functions (stage, count, error) record into the active report (see start_report). When no report is
+active they do nothing, so the instrumentation is cheap when it is turned off.
+"""
+
+import contextlib
+import cProfile
+import csv
+import json
+import os
+import time
+
+_report = None
+"""the active report, None if the instrumentation is turned off"""
+
+_no_stage = contextlib.nullcontext()
+
+
+class RunReport:
+    """
+    Timings, counters and errors of a run
+    """
+    def __init__(self, profile:bool=False):
+        """
+        :param profile bool: also profile the run with cProfile (see save_profile)
+        """
+        self._stages = []
+        """list of {"stage", "file", "seconds"}"""
+        self._counts = {}
+        """(file, channel, outcome) -> count"""
+        self._errors = []
+        """list of {"kind", ...}"""
+        self._profiler = cProfile.Profile() if profile else None
+
+    @contextlib.contextmanager
+    def stage(self, name:str, file:str=None):
+        """
+        Time the code run in the with block
+        :param name str: stage name
+        :param file str: file processed
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._stages.append({"stage": name, "file": file, "seconds": time.perf_counter() - start})
+
+    def count(self, file:str, channel:str, outcome:str, number:int=1):
+        key = (file, channel, outcome)
+        self._counts[key] = self._counts.get(key, 0) + number
+
+    def error(self, kind:str, **fields):
+        record = {"kind": kind}
+        record.update(fields)
+        self._errors.append(record)
+
+    @property
+    def stages(self):
+        return self._stages
+
+    @property
+    def errors(self):
+        return self._errors
+
+    def counts(self)-> list:
+        """
+        :return list: {"file", "channel", "outcome", "count"} for each counter
+        """
+        return [{"file": file, "channel": channel, "outcome": outcome, "count": number}
+                for (file, channel, outcome), number in self._counts.items()]
+
+    def merge(self, report:dict):
+        """
+        Add the records of another report, e.g. from a worker process
+        :param report dict: originate from RunReport.to_json()
+        :return: None
+        """
+        self._stages.extend(report["stages"])
+        for record in report["counts"]:
+            self.count(record["file"], record["channel"], record["outcome"], record["count"])
+        self._errors.extend(report["errors"])
+
+    def summary(self)-> dict:
+        """
+        :return dict: total time per stage and total count per outcome
+        """
+        stages = {}
+        for record in self._stages:
+            stages[record["stage"]] = stages.get(record["stage"], 0.0) + record["seconds"]
+        outcomes = {}
+        for (_, _, outcome), number in self._counts.items():
+            outcomes[outcome] = outcomes.get(outcome, 0) + number
+        return {"seconds": stages, "outcomes": outcomes, "errors": len(self._errors)}
+
+    def to_json(self)-> dict:
+        return {"summary": self.summary(),
+                "stages": self._stages,
+                "counts": self.counts(),
+                "errors": [{key: _to_builtin(value) for key, value in record.items()} for record in self._errors]}
+
+    def save(self, name:str):
+        """
+        Save the report in a json file, or in csv files (name_stages.csv, name_counts.csv, name_errors.csv) if name
+        ends with .csv
+        :param name str: file path
+        :return: None
+        """
+        report = self.to_json()
+        if not name.endswith(".csv"):
+            with open(name, "w") as outfile:
+                json.dump(report, outfile, indent=4, separators=(',', ': '))
+            return
+        base = os.path.splitext(name)[0]
+        for table in ["stages", "counts", "errors"]:
+            columns = []
+            for record in report[table]:
+                columns.extend(key for key in record if key not in columns)
+            with open(base + "_" + table + ".csv", "w", newline="") as outfile:
+                writer = csv.DictWriter(outfile, fieldnames=columns)
+                writer.writeheader()
+                writer.writerows(report[table])
+
+    def start_profile(self):
+        if self._profiler is not None:
+            self._profiler.enable()
+
+    def stop_profile(self):
+        if self._profiler is not None:
+            self._profiler.disable()
+
+    def save_profile(self, name:str):
+        """
+        Save the cProfile statistics (readable with pstats or snakeviz)
+        :param name str: file path
+        :return: None
+        """
+        if self._profiler is not None:
+            self._profiler.dump_stats(name)
+
+
+def _to_builtin(value):
+    """numpy numbers are converted so that the errors can be saved in json"""
+    return value.item() if hasattr(value, "item") else value
+
+
+def start_report(report:RunReport=None)-> RunReport:
+    """
+    Turn the instrumentation on
+    :param report RunReport: report to record into, a new one if None
+    :return RunReport: the active report
+    """
+    global _report
+    _report = report if report is not None else RunReport()
+    _report.start_profile()
+    return _report
+
+def stop_report()-> RunReport:
+    """
+    Turn the instrumentation off
+    :return RunReport: the report that was active (None if there was none)
+    """
+    global _report
+    report = _report
+    if report is not None:
+        report.stop_profile()
+    _report = None
+    return report
+
+def get_report()-> RunReport:
+    """
+    :return RunReport: the active report, None if the instrumentation is turned off
+    """
+    return _report
+
+def stage(name:str, file:str=None):
+    """
+    Time the with block in the active report
+    :param name str: stage name
+    :param file str: file processed
+    """
+    if _report is None:
+        return _no_stage
+    return _report.stage(name, file)
+
+def count(file:str, channel:str, outcome:str, number:int=1):
+    """
+    Increment an outcome counter of the active report
+    :param file str: file processed
+    :param channel str: channel (tab) processed
+    :param outcome str: e.g. "matched", "no_match"
+    :param number int: increment
+    :return: None
+    """
+    if _report is not None:
+        _report.count(file, channel, outcome, number)
+
+def error(kind:str, **fields):
+    """
+    Record an error in the active report
+    :param kind str: type of error, e.g. "ambiguous_match"
+    :param fields: description of the error
+    :return: None
+    """
+    if _report is not None:
+        _report.error(kind, **fields)
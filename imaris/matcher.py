@@ -0,0 +1,198 @@
+"""Spatial index used to match neurons between the intensity file and the volume file from their coordinates"""
+
+import numpy as np
+
+NO_MATCH = -1
+"""returned in place of a volume row when no (or more than one) neuron is within tolerance"""
+
+matching_strategies = ["unique", "assignment"]
+"""unique: a neuron is matched only if exactly one neuron is within tolerance (PositionIndex.match)
+assignment: neurons are matched one-to-one, nearest pairs first (PositionIndex.assign)"""
+
+
+def get_bounds(values:np.ndarray, relative_threshold:float, absolute_threshold:float)-> (np.ndarray, np.ndarray):
+    """
+    Compute the acceptable (open) interval around each coordinate.
+
+    A coordinate matches if it is either in the acceptable relative distance OR in an acceptable absolute distance.
+    Both intervals contain the coordinate, so their union is a single interval. When the coordinate is negative or
+    null the relative interval is empty and only the absolute one is used.
+    :param values np.ndarray: coordinates (one axis) of the neurons to match
+    :param relative_threshold float: relative tolerance
+    :param absolute_threshold float: absolute tolerance
+    :return (np.ndarray, np.ndarray): lower and upper bounds (excluded)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    relative_low = (1 - relative_threshold) * values
+    relative_high = (1 + relative_threshold) * values
+    absolute_low = values - absolute_threshold
+    absolute_high = values + absolute_threshold
+    relative_valid = relative_low < relative_high
+    low = np.where(relative_valid, np.minimum(relative_low, absolute_low), absolute_low)
+    high = np.where(relative_valid, np.maximum(relative_high, absolute_high), absolute_high)
+    return low, high
+
+
+class PositionIndex:
+    """
+    Index built once over the positions of a volume file.
+
+    Positions are sorted on X so that the neurons close to a given coordinate are found with a binary search. The
+    candidates are then filtered on Y and Z. All the neurons of a channel are queried at once.
+    """
+    def __init__(self, positions:np.ndarray):
+        """
+        :param positions np.ndarray: (n, 3) array of x, y, z coordinates, row i is the i-th neuron of the volume file
+        """
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        self._positions = positions
+        self._order = np.argsort(positions[:, 0], kind="stable")
+        """row numbers of the volume file sorted on X"""
+        self._sorted = positions[self._order]
+
+    @classmethod
+    def from_frame(cls, position_data):
+        """
+        :param position_data pd.DataFrame: "Position" tab of the volume file
+        :return PositionIndex:
+        """
+        return cls(position_data[["Position X", "Position Y", "Position Z"]].to_numpy(dtype=np.float64))
+
+    def __len__(self):
+        return len(self._order)
+
+    def candidates(self, positions:np.ndarray, relative_threshold:float, absolute_threshold:float)-> (np.ndarray, np.ndarray):
+        """
+        Find all the neurons of the volume file within tolerance on x, y and z
+        :param positions np.ndarray: (n, 3) array of coordinates to match
+        :param relative_threshold float: relative tolerance
+        :param absolute_threshold float: absolute tolerance
+        :return (np.ndarray, np.ndarray): query row and volume row of every candidate pair, sorted by query row
+        """
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        low_x, high_x = get_bounds(positions[:, 0], relative_threshold, absolute_threshold)
+        start = np.searchsorted(self._sorted[:, 0], low_x, side="right")
+        stop = np.searchsorted(self._sorted[:, 0], high_x, side="left")
+        counts = np.maximum(stop - start, 0)
+        """number of neurons within tolerance on X only"""
+
+        query = np.repeat(np.arange(len(positions)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        sorted_rows = np.repeat(start, counts) + offsets
+
+        keep = np.ones(len(query), dtype=bool)
+        for axis in (1, 2):
+            low, high = get_bounds(positions[query, axis], relative_threshold, absolute_threshold)
+            values = self._sorted[sorted_rows, axis]
+            keep &= (values > low) & (values < high)
+        return query[keep], self._order[sorted_rows[keep]]
+
+    def match(self, positions:np.ndarray, relative_threshold:float, absolute_threshold:float)-> (np.ndarray, np.ndarray):
+        """
+        Match each coordinate to the unique neuron within tolerance in the volume file
+        :param positions np.ndarray: (n, 3) array of coordinates to match
+        :param relative_threshold float: relative tolerance
+        :param absolute_threshold float: absolute tolerance
+        :return (np.ndarray, np.ndarray): matching volume row (NO_MATCH unless exactly one candidate) and number of
+        candidates for each coordinate
+        """
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        query, rows = self.candidates(positions, relative_threshold, absolute_threshold)
+        counts = np.bincount(query, minlength=len(positions))
+        matches = np.full(len(positions), NO_MATCH, dtype=np.int64)
+        unique = counts[query] == 1
+        matches[query[unique]] = rows[unique]
+        return matches, counts
+
+    def assign(self, positions:np.ndarray, relative_threshold:float,
+               absolute_threshold:float)-> (np.ndarray, np.ndarray, np.ndarray, np.ndarray):
+        """
+        Match the coordinates one-to-one with the neurons of the volume file within tolerance, see assign_candidates
+        :param positions np.ndarray: (n, 3) array of coordinates to match
+        :param relative_threshold float: relative tolerance
+        :param absolute_threshold float: absolute tolerance
+        :return (np.ndarray, np.ndarray, np.ndarray, np.ndarray): matching volume row (NO_MATCH if none), distance
+        and confidence of each match, and number of candidates for each coordinate
+        """
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        query, rows = self.candidates(positions, relative_threshold, absolute_threshold)
+        distances = np.linalg.norm(positions[query] - self._positions[rows], axis=1)
+        matches, match_distances, confidence = assign_candidates(query, rows, distances, len(positions))
+        return matches, match_distances, confidence, np.bincount(query, minlength=len(positions))
+
+
+def _first_per_group(groups:np.ndarray, distances:np.ndarray, rank:int=0)-> (np.ndarray, np.ndarray):
+    """
+    :param groups np.ndarray: group of each candidate pair
+    :param distances np.ndarray: distance of each candidate pair
+    :param rank int: 0 for the nearest candidate pair of each group, 1 for the second nearest
+    :return (np.ndarray, np.ndarray): the groups having such a candidate pair and the candidate pair numbers
+    """
+    order = np.lexsort((distances, groups))
+    if len(order) == 0:
+        return groups[order], order
+    sorted_groups = groups[order]
+    starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+    selected = starts + rank
+    selected = selected[selected < len(order)]
+    selected = selected[sorted_groups[selected] == sorted_groups[selected - rank]]
+    return sorted_groups[selected], order[selected]
+
+def assign_candidates(query:np.ndarray, rows:np.ndarray, distances:np.ndarray,
+                      count:int)-> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Global one-to-one assignment on the sparse graph of candidate pairs, nearest pairs first (greedy).
+    At each round, all the pairs that are mutually nearest (the query has no nearer free row and the row has no
+    nearer free query) are matched at once, until no candidate pair is left between free queries and free rows.
+
+    The confidence of a match is 1 - distance / distance of the nearest competing candidate (another row for the
+    query or another query for the row): 1 when there is no competitor, 0 when the competitor is as close or closer.
+    :param query np.ndarray: query of each candidate pair
+    :param rows np.ndarray: volume row of each candidate pair
+    :param distances np.ndarray: distance of each candidate pair
+    :param count int: number of queries
+    :return (np.ndarray, np.ndarray, np.ndarray): matching volume row (NO_MATCH if none), distance and confidence of
+    each query (NaN when not matched)
+    """
+    query = np.asarray(query, dtype=np.int64)
+    rows = np.asarray(rows, dtype=np.int64)
+    distances = np.asarray(distances, dtype=np.float64)
+    matches = np.full(count, NO_MATCH, dtype=np.int64)
+    match_distances = np.full(count, np.nan)
+    confidence = np.full(count, np.nan)
+    matched_pairs = []
+
+    active = np.arange(len(query))
+    """candidate pairs between a free query and a free row"""
+    while len(active):
+        _, nearest_for_query = _first_per_group(query[active], distances[active])
+        _, nearest_for_row = _first_per_group(rows[active], distances[active])
+        mutual = np.intersect1d(active[nearest_for_query], active[nearest_for_row], assume_unique=True)
+        matched_pairs.append(mutual)
+        matches[query[mutual]] = rows[mutual]
+        match_distances[query[mutual]] = distances[mutual]
+        matched_rows = np.zeros(rows.max() + 1, dtype=bool)
+        matched_rows[rows[mutual]] = True
+        active = active[(matches[query[active]] == NO_MATCH) & ~matched_rows[rows[active]]]
+
+    if matched_pairs:
+        competitor = np.full(len(query), np.inf)
+        """distance of the nearest other candidate of the query or of the row of each pair"""
+        for groups in [query, rows]:
+            nearest_groups, nearest = _first_per_group(groups, distances)
+            second_groups, second = _first_per_group(groups, distances, rank=1)
+            second_distance = np.full(groups.max() + 1, np.inf)
+            second_distance[second_groups] = distances[second]
+            nearest_distance = np.full(groups.max() + 1, np.inf)
+            nearest_distance[nearest_groups] = distances[nearest]
+            is_nearest = np.zeros(len(query), dtype=bool)
+            is_nearest[nearest] = True
+            competitor = np.minimum(competitor, np.where(is_nearest, second_distance[groups],
+                                                         nearest_distance[groups]))
+        matched = np.concatenate(matched_pairs)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            confidence[query[matched]] = np.where(np.isinf(competitor[matched]), 1.0,
+                                                  np.where(competitor[matched] <= distances[matched], 0.0,
+                                                           1.0 - distances[matched] / competitor[matched]))
+        """a competitor as close (including two pairs at distance 0) gives 0, not NaN"""
+    return matches, match_distances, confidence
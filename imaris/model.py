@@ -1,50 +1,81 @@
 
+import sys
+from array import array
+import numpy as np
+import pandas as pd
+
+
+def _intern(value):
+    """metadata strings take few distinct values, they are shared by all the data points"""
+    return sys.intern(value) if type(value) is str else value
+
+def _to_array(values)-> array:
+    """
+    :param values: volume or intensity values (list, numpy array, array)
+    :return array: the values as contiguous doubles
+    """
+    if type(values) is array and values.typecode == "d":
+        return values
+    if isinstance(values, np.ndarray):
+        converted = array("d")
+        converted.frombytes(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+        return converted
+    return array("d", values)
+
 
 class IntensityVolumeData:
     """
     Each data point is defined by various parameters, including the animal, sex, drug treatment etc.
 
+    Attributes are slotted (no per-instance __dict__), metadata strings are interned and the volume and intensity
+    values are stored as array("d") (contiguous doubles, not boxed floats).
     """
+    __slots__ = ["_drug", "_sex", "_animal", "_section", "_neuron", "_layer", "_disease", "_location", "_volume",
+                 "_intensity", "_source"]
+
     def __init__(self, drug:bool=None, sex:str=None,animal:int=None,section:int=None,neuron:str=None,layer:int=None,
                  disease:str=None,location:str=None,
-                 volume:list=None, intensity:list=None):
+                 volume:list=None, intensity:list=None, source:dict=None):
 
         self._drug = drug #type:bool
         """if the animal was treated with a drug or not"""
 
-        self._sex = sex #type: str
+        self._sex = _intern(sex) #type: str
         """if the animal is a male val="male" or a female val= "female" """
 
-        self._animal = animal #type: int
+        self._animal = _intern(animal) #type: int
         """animal number"""
 
-        self._section = section #type: int
+        self._section = _intern(section) #type: int
         """section number"""
 
-        self._neuron = neuron #type: str
+        self._neuron = _intern(neuron) #type: str
         """val="inhibitory" or val="excitatory" """
 
         self._layer = layer #type: int
         """layer in the section"""
 
-        self._disease = disease #type: str
+        self._disease = _intern(disease) #type: str
         """If the dataset represent the infected part of the animal ("ipsi") or not ("contra")"""
 
-        self._location = location #type:str
+        self._location = _intern(location) #type:str
         """intracellular (val="intra") or membrane (val="membrane") """
 
         if volume is not None:
-            self._volume = volume
+            self._volume = _to_array(volume) #type: array
         else:
-            self._volume = []
+            self._volume = array("d")
         """volume of each neuron, index match with intensity"""
 
         if intensity is not None:
-            self._intensity = intensity
+            self._intensity = _to_array(intensity) #type: array
         else:
-            self._intensity = []
+            self._intensity = array("d")
         """intensity of each neuron, index match with volume"""
 
+        self._source = source #type: dict
+        """the file pair (paths, sizes, modification times) and thresholds the data point was computed from"""
+
     @property
     def drug(self):
         return self._drug
@@ -59,7 +90,7 @@ class IntensityVolumeData:
 
     @sex.setter
     def sex(self, sex:str):
-        self._sex = sex
+        self._sex = _intern(sex)
 
     @property
     def animal(self):
@@ -67,7 +98,7 @@ class IntensityVolumeData:
 
     @animal.setter
     def animal(self,animal:int):
-        self._animal = animal
+        self._animal = _intern(animal)
 
     @property
     def section(self):
@@ -75,7 +106,7 @@ class IntensityVolumeData:
 
     @section.setter
     def section(self, section:int):
-        self._section = section
+        self._section = _intern(section)
 
     @property
     def neuron(self):
@@ -83,7 +114,7 @@ class IntensityVolumeData:
 
     @neuron.setter
     def neuron(self, neuron:str):
-        self._neuron = neuron
+        self._neuron = _intern(neuron)
 
     @property
     def layer(self):
@@ -99,7 +130,7 @@ class IntensityVolumeData:
 
     @disease.setter
     def disease(self, disease:bool):
-        self._disease = disease
+        self._disease = _intern(disease)
 
     @property
     def location(self):
@@ -107,7 +138,7 @@ class IntensityVolumeData:
 
     @location.setter
     def location(self, location:str):
-        self._location = location
+        self._location = _intern(location)
 
     @property
     def volume(self):
@@ -115,7 +146,7 @@ class IntensityVolumeData:
 
     @volume.setter
     def volume(self, volume:list):
-        self._volume = volume
+        self._volume = _to_array(volume)
 
     @property
     def intensity(self):
@@ -123,7 +154,15 @@ class IntensityVolumeData:
 
     @intensity.setter
     def intensity(self, intensity:list):
-        self._intensity = intensity
+        self._intensity = _to_array(intensity)
+
+    @property
+    def source(self):
+        return self._source
+
+    @source.setter
+    def source(self, source:dict):
+        self._source = source
 
     def to_json(self)->dict:
         return {
@@ -135,21 +174,135 @@ class IntensityVolumeData:
             "layer":self.layer,
             "disease":self.disease,
             "location":self.location,
-            "volume":self.volume,
-            "intensity": self.intensity
+            "volume":self.volume.tolist(),
+            "intensity": self.intensity.tolist(),
+            "source": self.source
         }
 
+query_fields = ["drug", "sex", "animal", "section", "neuron", "layer", "disease", "location"]
+"""metadata fields indexed by ResearchData to query the data points"""
+
 class ResearchData:
     """
     Contains all data points (IntensityVolumeData) in the dataset.
 
-    More could be done in the future to query data.
+    Each metadata field (query_fields) is indexed: value -> positions of the data points, so that data points can be
+    selected and grouped without scanning all of them. Data points should not be modified once added.
     """
     def __init__(self):
         self._datapoints = []
+        self._indexes = {field: {} for field in query_fields}
+        """field -> value -> list of the positions of the data points having that value"""
 
     def add_data(self, point:IntensityVolumeData):
+        position = len(self._datapoints)
         self._datapoints.append(point)
+        for field in query_fields:
+            self._indexes[field].setdefault(getattr(point, field), []).append(position)
+
+    def __iter__(self):
+        return iter(self._datapoints)
+
+    def __len__(self):
+        return len(self._datapoints)
+
+    def values(self, field:str)-> list:
+        """
+        :param field str: metadata field
+        :return list: distinct values of the field in the dataset
+        """
+        return list(self._indexes[field])
+
+    def _positions(self, **criteria)-> np.ndarray:
+        """
+        :param criteria: field=value or field=[values]
+        :return np.ndarray: sorted positions of the data points matching all the criteria
+        """
+        positions = np.arange(len(self._datapoints))
+        for field, accepted in criteria.items():
+            if field not in self._indexes:
+                raise KeyError("cannot query on " + field + ", expected one of " + str(query_fields))
+            if not isinstance(accepted, (list, tuple, set)):
+                accepted = [accepted]
+            field_positions = [self._indexes[field].get(value, []) for value in accepted]
+            field_positions = np.unique(np.concatenate(field_positions)) if field_positions else np.zeros(0)
+            positions = np.intersect1d(positions, field_positions.astype(np.int64), assume_unique=True)
+        return positions
+
+    def select(self, **criteria)-> "ResearchData":
+        """
+        Filter the data points, e.g. select(sex="male", layer=[1, 2])
+        :param criteria: field=value or field=[values], all criteria must be met
+        :return ResearchData: the matching data points (same objects)
+        """
+        research = ResearchData()
+        for position in self._positions(**criteria):
+            research.add_data(self._datapoints[position])
+        return research
+
+    def _group_codes(self, fields:tuple)-> (np.ndarray, list):
+        """
+        :param fields tuple: metadata fields
+        :return (np.ndarray, list): group number of each data point and key (tuple of values) of each group
+        """
+        combined = np.zeros(len(self._datapoints), dtype=np.int64)
+        values = []
+        for field in fields:
+            field_values = list(self._indexes[field])
+            codes = np.empty(len(self._datapoints), dtype=np.int64)
+            for code, value in enumerate(field_values):
+                codes[self._indexes[field][value]] = code
+            combined = combined * len(field_values) + codes
+            values.append(field_values)
+        groups, group_codes = np.unique(combined, return_inverse=True)
+        keys = []
+        for group in groups:
+            key = []
+            for field_values in reversed(values):
+                group, code = divmod(int(group), len(field_values))
+                key.append(field_values[code])
+            keys.append(tuple(reversed(key)))
+        return group_codes.reshape(-1), keys
+
+    def group_by(self, *fields)-> dict:
+        """
+        :param fields: metadata fields, e.g. group_by("sex", "layer")
+        :return dict: tuple of values -> ResearchData
+        """
+        group_codes, keys = self._group_codes(fields)
+        groups = {key: ResearchData() for key in keys}
+        for position, code in enumerate(group_codes):
+            groups[keys[code]].add_data(self._datapoints[position])
+        return groups
+
+    def aggregate(self, *fields)-> pd.DataFrame:
+        """
+        Count, sum and mean of the volume and intensity values of all the neurons of each group, and the density
+        (intensity sum / volume sum)
+        :param fields: metadata fields to group by, no field aggregates the whole dataset
+        :return pd.DataFrame: one row per group, indexed by the fields
+        """
+        group_codes, keys = self._group_codes(fields)
+        result = {}
+        for measurement in ["volume", "intensity"]:
+            lengths = np.fromiter((len(getattr(point, measurement)) for point in self._datapoints), dtype=np.int64,
+                                  count=len(self._datapoints))
+            values = [getattr(point, measurement) for point in self._datapoints]
+            values = np.concatenate(values).astype(np.float64) if values else np.zeros(0)
+            value_groups = np.repeat(group_codes, lengths)
+            count = np.bincount(value_groups, minlength=len(keys))
+            total = np.bincount(value_groups, weights=values, minlength=len(keys))
+            result[measurement + "_count"] = count
+            result[measurement + "_sum"] = total
+            with np.errstate(divide="ignore", invalid="ignore"):
+                result[measurement + "_mean"] = total / count
+        with np.errstate(divide="ignore", invalid="ignore"):
+            result["density"] = result["intensity_sum"] / result["volume_sum"]
+        if fields:
+            index = pd.MultiIndex.from_tuples(keys, names=list(fields))
+        else:
+            index = pd.RangeIndex(len(keys))
+        return pd.DataFrame(result, index=index)
 
     def to_json(self):
         index = 0
@@ -174,7 +327,8 @@ def _from_dict_to_int_vol(dict_obj)-> IntensityVolumeData:
                                 disease=dict_obj["disease"],
                                 location=dict_obj["location"],
                                 volume=dict_obj["volume"],
-                                intensity=dict_obj["intensity"]
+                                intensity=dict_obj["intensity"],
+                                source=dict_obj.get("source")
                                 )
     return model
 
@@ -0,0 +1,185 @@
+"""Normalization of the disease state (ipsi) by the healthy state (contra)
+
+The intensity sum values of each ipsi data point are divided by the average intensity sum of the corresponding contra
+neurons (same animal, section, neuron type, layer and location).
+
+The baselines are saved next to the model (see save_baseline), an incremental build only updates them with the data
+points of the file pairs processed again.
+"""
+
+import json
+import logging
+import numpy as np
+from .model import IntensityVolumeData, ResearchData
+from . import instrumentation
+from .xls_cache import _replace
+
+logger = logging.getLogger(__name__)
+
+baseline_fields = ["drug", "sex", "animal", "section", "neuron", "layer", "location"]
+"""fields identifying the contra data points an ipsi data point is normalized by"""
+
+
+def get_baseline_key(point:IntensityVolumeData)-> tuple:
+    """
+    :param point IntensityVolumeData: data point
+    :return tuple: values of the baseline fields
+    """
+    return tuple(getattr(point, field) for field in baseline_fields)
+
+
+class ContraBaseline:
+    """
+    Average contra intensity sum for each baseline key. Sums and counts are kept so that the baselines are updated
+    when a data point is added instead of being computed again.
+    """
+    def __init__(self):
+        self._sums = {}
+        """baseline key -> sum of the contra intensity values"""
+        self._counts = {}
+        """baseline key -> number of contra intensity values"""
+
+    def add(self, point:IntensityVolumeData):
+        """
+        Update the baseline with a data point, non contra data points are ignored
+        :param point IntensityVolumeData: data point
+        :return: None
+        """
+        if point.disease != "contra":
+            return
+        key = get_baseline_key(point)
+        self._sums[key] = self._sums.get(key, 0.0) + float(np.sum(point.intensity))
+        self._counts[key] = self._counts.get(key, 0) + len(point.intensity)
+
+    def remove(self, point:IntensityVolumeData):
+        """
+        Remove a data point added before (e.g. its file pair changed), non contra data points are ignored
+        :param point IntensityVolumeData: data point
+        :return: None
+        """
+        if point.disease != "contra":
+            return
+        key = get_baseline_key(point)
+        self._sums[key] -= float(np.sum(point.intensity))
+        self._counts[key] -= len(point.intensity)
+        if self._counts[key] <= 0:
+            del self._sums[key]
+            del self._counts[key]
+
+    def add_research_data(self, research:ResearchData):
+        """
+        Update the baselines with all the contra data points, in one grouped pass
+        :param research ResearchData: the data points
+        :return: None
+        """
+        for key, group in research.select(disease="contra").group_by(*baseline_fields).items():
+            intensities = [point.intensity for point in group]
+            values = np.concatenate(intensities) if intensities else np.zeros(0)
+            self._sums[key] = self._sums.get(key, 0.0) + float(np.sum(values))
+            self._counts[key] = self._counts.get(key, 0) + len(values)
+
+    def mean(self, key:tuple)-> float:
+        """
+        :param key tuple: baseline key (see get_baseline_key)
+        :return float: average contra intensity, None if there is no contra value for the key
+        """
+        if not self._counts.get(key):
+            return None
+        return self._sums[key] / self._counts[key]
+
+    def normalize(self, point:IntensityVolumeData)-> IntensityVolumeData:
+        """
+        :param point IntensityVolumeData: ipsi data point
+        :return IntensityVolumeData: copy of the data point with the intensity divided by the baseline, None if there
+        is no baseline
+        """
+        baseline = self.mean(get_baseline_key(point))
+        if baseline is None:
+            return None
+        normalized = _copy_point(point)
+        normalized.intensity = np.asarray(point.intensity, dtype=np.float64) / baseline
+        return normalized
+
+    def to_json(self)-> list:
+        return [[list(key), self._sums[key], self._counts[key]] for key in self._sums]
+
+    @classmethod
+    def from_json(cls, baselines:list)-> "ContraBaseline":
+        """
+        :param baselines list: originate from ContraBaseline.to_json()
+        :return ContraBaseline: the baselines
+        """
+        baseline = cls()
+        for key, total, count in baselines:
+            baseline._sums[tuple(key)] = total
+            baseline._counts[tuple(key)] = count
+        return baseline
+
+
+def _copy_point(point:IntensityVolumeData)-> IntensityVolumeData:
+    return IntensityVolumeData(drug=point.drug, sex=point.sex, animal=point.animal, section=point.section,
+                               neuron=point.neuron, layer=point.layer, disease=point.disease,
+                               location=point.location, volume=point.volume[:], intensity=point.intensity[:],
+                               source=point.source)
+
+def save_baseline(baseline:ContraBaseline, name:str, sources:list):
+    """
+    :param baseline ContraBaseline: the baselines of a model
+    :param name str: json file path
+    :param sources list: sources of the file pairs of the model (see build_model.get_source), the baselines are only
+    reused with the same model
+    :return: None
+    """
+    def write(path):
+        with open(path, "w") as outfile:
+            json.dump({"sources": sources, "baselines": baseline.to_json()}, outfile)
+    _replace(name, write)
+
+def load_baseline(name:str)-> (ContraBaseline, list):
+    """
+    :param name str: json file path written by save_baseline
+    :return (ContraBaseline, list): the baselines and the sources of the file pairs they were computed from,
+    (None, None) if the file does not exist or is invalid
+    """
+    try:
+        with open(name) as infile:
+            saved = json.load(infile)
+        return ContraBaseline.from_json(saved["baselines"]), saved["sources"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None, None
+
+def normalize_research_data(research:ResearchData, baseline:ContraBaseline=None)-> ResearchData:
+    """
+    Normalize all the ipsi data points by their contra baseline
+    :param research ResearchData: the data points
+    :param baseline ContraBaseline: baselines already computed (e.g. kept from a previous call), computed from
+    research if None
+    :return ResearchData: the normalized ipsi data points
+    """
+    if baseline is None:
+        baseline = ContraBaseline()
+        baseline.add_research_data(research)
+
+    points = []
+    means = []
+    for point in research.select(disease="ipsi"):
+        mean = baseline.mean(get_baseline_key(point))
+        if mean is None:
+            key = dict(zip(baseline_fields, get_baseline_key(point)))
+            instrumentation.error("no_contra_baseline", **key)
+            logger.warning("no contra baseline for %s", key)
+        else:
+            points.append(point)
+            means.append(mean)
+
+    lengths = np.array([len(point.intensity) for point in points], dtype=np.int64)
+    intensities = np.concatenate([point.intensity for point in points]) if points else np.zeros(0)
+    normalized_values = np.asarray(intensities, dtype=np.float64) / np.repeat(means, lengths)
+    """all the ipsi values are divided at once"""
+
+    normalized = ResearchData()
+    for point, values in zip(points, np.split(normalized_values, np.cumsum(lengths)[:-1])):
+        normalized_point = _copy_point(point)
+        normalized_point.intensity = values
+        normalized.add_data(normalized_point)
+    return normalized
@@ -0,0 +1,114 @@
+"""Pairing of the Excel files on their names
+
+The file names follow the naming convention of the schema (see schema), e.g.
+drug_sex_animal_section_neuron_disease_type.xls for the default schema. The files are paired on all the fields except
+for the type (intensity vs volume), before any Excel file is opened.
+
+This module does not use pandas so that the file names can be checked quickly (see cli validate).
+"""
+
+import os
+import glob
+import logging
+from . import instrumentation
+from .schema import get_schema
+
+logger = logging.getLogger(__name__)
+
+
+def list_files(path:str)-> list:
+    """
+    :param path str: folder
+    :return list: sorted paths of the Excel files of the folder
+    """
+    return sorted(glob.glob(path+"/*.xls"))
+
+def get_info(file:str)->list:
+    """
+    Parse the file name accordingly
+    :param file str: Excel file path
+    :return: List of identifiers to understand the content of the file
+    """
+    _, name = os.path.split(file)
+    name = name.split(".xls")[0]
+    info = name.split("_")
+    return info
+
+def index_files(files:list, schema=None, file_type:str=None)-> (dict, dict):
+    """
+    Parse all the file names of a folder once and index them on their identifiers
+    (drug, sex, animal, section, neuron, disease), i.e. all the attributes except for the last one (volume vs intensity)
+    :param files list: Excel file paths
+    :param schema: Schema (or name of a registered schema) defining the naming convention, the default schema if None
+    :param file_type str: type of the files of the folder ("intensity" or "volume"), any type if None
+    :return (dict, dict): identifier tuple -> file path, and identifier tuple -> all file paths for duplicated identifiers
+    :raise ValueError: listing all the file names that do not follow the naming convention or are not of file_type
+    """
+    index = {}
+    duplicates = {}
+    malformed = []
+    for file in files:
+        info = get_info(file)
+        try:
+            get_schema(schema).check_info(info, file, file_type)
+        except ValueError as error:
+            malformed.append(str(error))
+            continue
+        key = tuple(info[:-1])
+        if key in index:
+            duplicates.setdefault(key, [index[key]]).append(file)
+        else:
+            index[key] = file
+    if malformed:
+        raise ValueError(str(len(malformed)) + " malformed file name(s):\n" + "\n".join(malformed))
+    for key in duplicates:
+        del index[key]
+        """duplicated identifiers are reported rather than silently using the first file"""
+    return index, duplicates
+
+def pair_files(intensity_files:list, intra_files:list, schema=None)-> (list, list, list, dict):
+    """
+    Pair each intensity file with its intracellular (volume) file before any Excel file is opened.
+    The corresponding file will have all the same attributes except for the last one (volume vs intensity)
+    :param intensity_files list: of all files containing intensity data
+    :param intra_files list: of all files containing intracellular data
+    :param schema: Schema (or name of a registered schema) defining the naming convention, the default schema if None
+    :return (list, list, list, dict): (intensity file, intra file) pairs, unpaired intensity files, unpaired intra files
+    and duplicated identifier -> files
+    :raise ValueError: listing all the file names that do not follow the naming convention or are in the wrong list
+    """
+    intensity_index, intensity_duplicates = index_files(intensity_files, schema, "intensity")
+    intra_index, intra_duplicates = index_files(intra_files, schema, "volume")
+    """a volume file in the intensity folder (or the opposite) is malformed, as in cli validate"""
+    pairs = [(intensity_index[key], intra_index[key]) for key in intensity_index if key in intra_index]
+    unpaired_intensity = [intensity_index[key] for key in intensity_index
+                          if key not in intra_index and key not in intra_duplicates]
+    unpaired_intra = [intra_index[key] for key in intra_index
+                      if key not in intensity_index and key not in intensity_duplicates]
+    duplicates = dict(intensity_duplicates)
+    for key, files in intra_duplicates.items():
+        duplicates.setdefault(key, []).extend(files)
+    return pairs, unpaired_intensity, unpaired_intra, duplicates
+
+def get_pairs(intensity_path:str,intra_path:str,schema=None)-> list:
+    """
+    Pair the files of the intensity and intra folders, reporting the files that cannot be paired
+    :param intensity_path str: path to the intensity folder
+    :param intra_path str: path to the intra (or volume) folder
+    :param schema: Schema (or name of a registered schema) defining the naming convention, the default schema if None
+    :return list: (intensity file, intra file) pairs
+    :raise ValueError: listing all the file names that do not follow the naming convention or are in the wrong folder
+    """
+    pairs, unpaired_intensity, unpaired_intra, duplicates = pair_files(list_files(intensity_path),
+                                                                       list_files(intra_path), schema)
+    """all the files are paired before any Excel file is opened"""
+    for intensity_file in unpaired_intensity:
+        instrumentation.error("unpaired_intensity", file=intensity_file)
+        logger.warning("could not find intra equivalent for %s", intensity_file)
+    for intra_file in unpaired_intra:
+        instrumentation.error("unpaired_intra", file=intra_file)
+        logger.warning("could not find intensity equivalent for %s", intra_file)
+    for files in duplicates.values():
+        instrumentation.error("duplicated_identifiers", files=files)
+        logger.warning("duplicated identifiers, files ignored: %s", ", ".join(files))
+    return pairs
@@ -0,0 +1,68 @@
+"""Prefetching of the Excel files
+
+On remote storage (e.g. a NAS) reading the files takes as long as processing them. prefetch_pairs reads the bytes of
+the upcoming file pairs in background threads while the current pair is processed. At most `depth` pairs are read
+ahead: reading waits when the consumer is slower (backpressure) and the files are never all loaded at once. Files
+whose tabs are all in the sheet cache (see xls_cache) can be skipped, they are not read at all.
+"""
+
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+
+def read_bytes(path:str)-> bytes:
+    """
+    :param path str: file path
+    :return bytes: the content of the file
+    """
+    with open(path, "rb") as infile:
+        return infile.read()
+
+def prefetch_files(files:list, depth:int=2, threads:int=2, skip=None):
+    """
+    Read files ahead of their use, in order
+    :param files list: file paths, or tuples of file paths read together
+    :param depth int: number of items read ahead of the one being used
+    :param threads int: number of reading threads
+    :param skip function: called with a file path (in a reading thread), True if the file does not need to be read
+    (e.g. its tabs are cached), every file is read if None
+    :return generator: (item, content) for each item of files, content being the bytes (or tuple of bytes) of the
+    file(s), None for the skipped files
+    """
+    def read_file(path):
+        if skip is not None and skip(path):
+            return None
+        return read_bytes(path)
+
+    def read(item):
+        if isinstance(item, tuple):
+            return tuple(read_file(path) for path in item)
+        return read_file(item)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = []
+        """futures of the items read ahead, in order"""
+        upcoming = iter(files)
+        for item in upcoming:
+            pending.append((item, executor.submit(read, item)))
+            if len(pending) >= depth:
+                break
+        while pending:
+            item, future = pending.pop(0)
+            for next_item in itertools.islice(upcoming, 1):
+                pending.append((next_item, executor.submit(read, next_item)))
+            """submitted when the consumer asks for the item: depth items are read while it is processed"""
+            yield item, future.result()
+
+def prefetch_pairs(pairs:list, depth:int=2, threads:int=2, skip=None):
+    """
+    Read the intensity and volume files of the pairs ahead of their processing, in order
+    :param pairs list: (intensity file, intra file) pairs
+    :param depth int: number of pairs read ahead of the one being processed
+    :param threads int: number of reading threads
+    :param skip function: called with a file path, True if the file does not need to be read (see prefetch_files)
+    :return generator: (intensity file, intra file, intensity bytes, intra bytes) for each pair, None in place of the
+    bytes of the skipped files
+    """
+    for (intensity_file, intra_file), (intensity_bytes, intra_bytes) in prefetch_files(pairs, depth, threads, skip):
+        yield intensity_file, intra_file, intensity_bytes, intra_bytes
@@ -0,0 +1,301 @@
+"""Schemas of the IMARIS exports
+
+A Schema describes an experiment type:
+    - the channels: for each channel, its layer, its location (membrane or intra) and the tabs holding its intensity
+      sum and intensity mean
+    - the file naming convention (fields of the file name and their translation)
+    - the columns read in each kind of tab and their dtypes
+
+Each schema is compiled once into parse plans (which tabs, which columns, which dtypes) reused by all the readers,
+so that only the tabs needed by a reader are parsed.
+
+Schemas are registered by name (see register_schema). A new antibody panel can be described in a json file and
+loaded with load_schema, without code changes. The "kcc2" schema is the default one.
+"""
+
+import json
+
+info_fields = ["drug", "sex", "animal", "section", "neuron", "disease"]
+"""data point fields (model.query_fields) a file name can set, layer and location are set by the channel.
+Not imported from model so that the file names can be checked without loading pandas (see cli validate)"""
+
+locations = ["membrane", "intra"]
+file_types = ["intensity", "volume"]
+
+
+class Channel:
+    """
+    A channel of the intensity file: one tab with the intensity sum and one tab with the intensity mean of the neurons
+    """
+    def __init__(self, number:int, layer:int, location:str, image:int=1, sum_sheet:str=None, mean_sheet:str=None):
+        """
+        :param number int: channel number, e.g. 10 for the tabs "Intensity Sum Ch=10 Img=1" and
+        "Intensity Mean Ch=10 Img=1"
+        :param layer int: spinal cord layer of the channel
+        :param location str: "membrane" or "intra"
+        :param image int: image number of the tabs
+        :param sum_sheet str: name of the intensity sum tab, deduced from number and image if None
+        :param mean_sheet str: name of the intensity mean tab, deduced from number and image if None
+        """
+        self.number = number
+        self.layer = layer
+        self.location = location
+        self.image = image
+        suffix = " Ch=" + str(number) + " Img=" + str(image)
+        self.sum_sheet = sum_sheet if sum_sheet is not None else "Intensity Sum" + suffix
+        self.mean_sheet = mean_sheet if mean_sheet is not None else "Intensity Mean" + suffix
+
+    @property
+    def name(self)-> str:
+        """the channel is identified by its intensity mean tab name (e.g. in layer_dict and in the run reports)"""
+        return self.mean_sheet
+
+    def to_json(self)-> dict:
+        return {"number": self.number, "layer": self.layer, "location": self.location, "image": self.image,
+                "sum_sheet": self.sum_sheet, "mean_sheet": self.mean_sheet}
+
+
+class ParsePlan:
+    """
+    Tabs, columns and dtypes read from a file by a reader
+    """
+    def __init__(self, sheets:dict, dtype:dict, header:int):
+        """
+        :param sheets dict: tab name -> list of the columns to read
+        :param dtype dict: column name -> dtype, for the columns read
+        :param header int: row of the column names
+        """
+        self.sheets = sheets
+        self.dtype = dtype
+        self.header = header
+
+
+class Schema:
+    """
+    Channels, file naming convention and columns of an experiment type
+    """
+    def __init__(self, name:str, channels:list, fields:list, types:dict, columns:dict, dtypes:dict, header:int=1):
+        """
+        :param name str: name of the schema in the registry
+        :param channels list: Channel of the intensity files, in the order of the data points
+        :param fields list: (field name, translation) for each field of the file name (before the type),
+        translation is a dictionary (file name value -> field value) or None to keep the value as is (digits only)
+        :param types dict: last field of the file name -> type of file ("intensity" or "volume")
+        :param columns dict: kind of tab ("position", "volume", "sum", "mean") -> list of the columns to read
+        :param dtypes dict: column name -> dtype
+        :param header int: row of the column names in the tabs
+        :raise ValueError: if a field, location or type is unknown
+        """
+        self.name = name
+        self.channels = list(channels)
+        self.fields = [(field, translation) for field, translation in fields]
+        self.types = dict(types)
+        self.columns = {kind: list(names) for kind, names in columns.items()}
+        self.dtypes = dict(dtypes)
+        self.header = header
+        self._channels = {channel.name: channel for channel in self.channels}
+        self._check()
+        self._plans = self._compile()
+
+    def _check(self):
+        """
+        Fail when the schema is built (or loaded) rather than after the first workbook is parsed
+        :raise ValueError: if a field, location or type is unknown
+        """
+        names = [field for field, _ in self.fields]
+        for field in names:
+            if field not in info_fields:
+                raise ValueError("unknown field " + str(field) + " in schema " + str(self.name) + ", expected one of " +
+                                 str(info_fields))
+        if len(set(names)) != len(names):
+            raise ValueError("duplicated field in schema " + str(self.name) + ": " + str(names))
+        for channel in self.channels:
+            if channel.location not in locations:
+                raise ValueError("unknown location " + str(channel.location) + " of channel " + channel.name +
+                                 " in schema " + str(self.name) + ", expected one of " + str(locations))
+        for file_type in self.types.values():
+            if file_type not in file_types:
+                raise ValueError("unknown file type " + str(file_type) + " in schema " + str(self.name) +
+                                 ", expected one of " + str(file_types))
+
+    def _compile(self)-> dict:
+        """
+        :return dict: reader -> ParsePlan
+        """
+        def plan(sheets):
+            read = {column for columns in sheets.values() for column in columns}
+            return ParsePlan(sheets, {column: dtype for column, dtype in self.dtypes.items() if column in read},
+                             self.header)
+
+        geometry = {"Position": self.columns["position"], "Volume": self.columns["volume"]}
+        intensity = dict(geometry)
+        intensity.update({channel.sum_sheet: self.columns["sum"] for channel in self.channels})
+        return {"intensity": plan(intensity),
+                "volume": plan(dict(geometry)),
+                "intensity_mean": plan({channel.mean_sheet: self.columns["mean"] for channel in self.channels})}
+
+    def plan(self, reader:str)-> ParsePlan:
+        """
+        :param reader str: "intensity" (intensity file read by read_xls), "volume" (volume file read by read_xls) or
+        "intensity_mean" (intensity file read by read_xls_intensity_mean)
+        :return ParsePlan: the plan compiled with the schema
+        """
+        return self._plans[reader]
+
+    def channel(self, name:str)-> Channel:
+        """
+        :param name str: channel name (intensity mean tab name)
+        :return Channel: the channel, None if the schema has no channel with this name
+        """
+        return self._channels.get(name)
+
+    def channel_names(self, location:str=None)-> list:
+        """
+        :param location str: "membrane" or "intra", all the channels if None
+        :return list: names of the channels
+        """
+        return [channel.name for channel in self.channels if location is None or channel.location == location]
+
+    def set_info(self, info:list, model):
+        """
+        Set the fields of a data point from its parsed file name (see pairing.get_info)
+        :param info list: parsed file name
+        :param model IntensityVolumeData: data point
+        :return: None
+        """
+        for (field, translation), value in zip(self.fields, info):
+            setattr(model, field, translation[value] if translation is not None else value)
+
+    def check_info(self, info:list, file:str=None, file_type:str=None):
+        """
+        Check that a parsed file name follows the naming convention
+        :param info list: parsed file name
+        :param file str: Excel file path, used in the error message
+        :param file_type str: expected type of file ("intensity" or "volume"), any type if None
+        :return: None
+        :raise ValueError: if the file name does not follow the naming convention or is not of the expected type
+        """
+        if len(info) != len(self.fields) + 1:
+            raise ValueError("expected " + str(len(self.fields) + 1) + " fields (" +
+                             "_".join(field for field, _ in self.fields) + "_type) in file name " + str(file))
+        for position, (_, translation) in enumerate(self.fields):
+            if translation is None:
+                if not info[position].isdigit():
+                    raise ValueError("field " + str(position) + " should be an integer in file name " + str(file))
+            elif info[position] not in translation:
+                raise ValueError("field " + str(position) + " should be one of " + str(list(translation)) +
+                                 " in file name " + str(file))
+        if info[-1] not in self.types:
+            raise ValueError("type should be one of " + str(list(self.types)) + " in file name " + str(file))
+        if file_type is not None and self.types[info[-1]] != file_type:
+            raise ValueError("type should be " + file_type + " (not " + self.types[info[-1]] + ") in file name " +
+                             str(file))
+
+    def to_json(self)-> dict:
+        return {"name": self.name,
+                "channels": [channel.to_json() for channel in self.channels],
+                "fields": [[field, translation] for field, translation in self.fields],
+                "types": self.types,
+                "columns": self.columns,
+                "dtypes": self.dtypes,
+                "header": self.header}
+
+    @classmethod
+    def from_json(cls, schema:dict)-> "Schema":
+        """
+        :param schema dict: originate from Schema.to_json(), "columns", "dtypes" and "header" default to the ones of
+        the kcc2 schema
+        :return Schema: the schema
+        :raise ValueError: if the schema is invalid
+        """
+        try:
+            channels = [Channel(**channel) for channel in schema["channels"]]
+            name = schema["name"]
+        except (KeyError, TypeError) as error:
+            raise ValueError("invalid schema, " + type(error).__name__ + ": " + str(error))
+        return cls(name=name,
+                   channels=channels,
+                   fields=schema.get("fields", kcc2_fields),
+                   types=schema.get("types", kcc2_types),
+                   columns=schema.get("columns", kcc2_columns),
+                   dtypes=schema.get("dtypes", kcc2_dtypes),
+                   header=schema.get("header", 1))
+
+
+"""The Excel files follow a strict naming convention
+drug_sex_animal_section_neuron_disease_type.xls
+
+drug -> d (drug) or n (no drug)
+sex -> m (male) or f (female)
+animal -> integer 1 to 12 (animal number)
+section -> integer 1 to 3 (section number)
+neuron -> i (inhibitory) or e (excitatory)
+disease -> c (contra) or i (ipsi)
+type -> i (intensity) or v (volume)
+"""
+kcc2_fields = [("drug", {"d": True, "n": False}),
+               ("sex", {"m": "male", "f": "female"}),
+               ("animal", None),
+               ("section", None),
+               ("neuron", {"e": "excitatory", "i": "inhibitory"}),
+               ("disease", {"i": "ipsi", "c": "contra"})]
+kcc2_types = {"i": "intensity", "v": "volume"}
+
+kcc2_columns = {"position": ["ID", "Position X", "Position Y", "Position Z"],
+                "volume": ["ID", "Volume"],
+                "sum": ["ID", "Intensity Sum"],
+                "mean": ["Intensity Mean"]}
+kcc2_dtypes = {"ID": "int32",
+               "Position X": "float64",
+               "Position Y": "float64",
+               "Position Z": "float64",
+               "Volume": "float64",
+               "Intensity Sum": "float64",
+               "Intensity Mean": "float64"}
+
+kcc2_schema = Schema(name="kcc2",
+                     channels=[Channel(10, 1, "membrane"), Channel(12, 2, "membrane"), Channel(14, 3, "membrane"),
+                               Channel(16, 4, "membrane"),
+                               Channel(9, 1, "intra"), Channel(11, 2, "intra"), Channel(13, 3, "intra"),
+                               Channel(15, 4, "intra")],
+                     fields=kcc2_fields, types=kcc2_types, columns=kcc2_columns, dtypes=kcc2_dtypes)
+"""KCC2 panel: even channels are the membrane, odd channels the intracellular space of layers 1 to 4"""
+
+_schemas = {kcc2_schema.name: kcc2_schema}
+"""registry, name -> Schema"""
+
+default_schema = kcc2_schema.name
+"""name of the schema used when none is given"""
+
+
+def register_schema(schema:Schema):
+    """
+    :param schema Schema: schema available by its name (replaces a schema with the same name)
+    :return: None
+    """
+    _schemas[schema.name] = schema
+
+def get_schema(schema=None)-> Schema:
+    """
+    :param schema: Schema, name of a registered schema, or None for the default schema
+    :return Schema: the schema
+    :raise ValueError: if no schema is registered with this name
+    """
+    if isinstance(schema, Schema):
+        return schema
+    name = schema if schema is not None else default_schema
+    if name not in _schemas:
+        raise ValueError("unknown schema " + str(name) + ", expected one of " + str(list(_schemas)))
+    return _schemas[name]
+
+def load_schema(path:str)-> Schema:
+    """
+    Read a schema from a json file (see Schema.from_json) and register it
+    :param path str: json file path
+    :return Schema: the schema
+    :raise ValueError: if the schema is invalid
+    """
+    with open(path) as infile:
+        schema = Schema.from_json(json.load(infile))
+    register_schema(schema)
+    return schema
@@ -0,0 +1,288 @@
+"""SQLite store of the research data, to compare cohorts without loading several models in memory
+
+Two tables:
+    datapoints     one row per data point: the cohort (e.g. "CLP290"), the metadata fields and the source (json)
+    measurements   one row per value of a data point: its quantity ("volume" or "intensity"), its position in the
+                   list of the data point and the value. The volume and intensity lists of a data point are stored
+                   separately: they are not aligned when neurons with a negative membrane volume only kept their
+                   intensity (see xls_reader.get_membrane_data).
+
+The data points are inserted in one transaction per cohort, with batched writes. The database uses write-ahead logging
+so that several notebooks can read it while a cohort is being inserted.
+
+The query helpers return pandas DataFrames, the aggregation is done by SQLite.
+"""
+
+import contextlib
+import itertools
+import json
+import pathlib
+import sqlite3
+import pandas as pd
+from .model import IntensityVolumeData, ResearchData, query_fields
+
+store_fields = ["cohort"] + query_fields
+"""fields the data points can be selected and grouped on"""
+
+quantities = ["volume", "intensity"]
+"""values stored for each data point, in the measurements table"""
+
+_tables = """
+CREATE TABLE IF NOT EXISTS datapoints (
+    id INTEGER PRIMARY KEY,
+    cohort TEXT NOT NULL,
+    drug INTEGER,
+    sex TEXT,
+    animal TEXT,
+    section TEXT,
+    neuron TEXT,
+    layer INTEGER,
+    disease TEXT,
+    location TEXT,
+    source TEXT
+);
+CREATE TABLE IF NOT EXISTS measurements (
+    datapoint INTEGER NOT NULL REFERENCES datapoints(id),
+    quantity TEXT NOT NULL CHECK (quantity IN ('volume', 'intensity')),
+    position INTEGER NOT NULL,
+    value REAL,
+    PRIMARY KEY (datapoint, quantity, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS datapoints_groups ON datapoints (cohort, drug, sex, neuron, disease, location, layer);
+CREATE INDEX IF NOT EXISTS datapoints_animals ON datapoints (cohort, animal, section);
+"""
+"""measurements are clustered on their data point (WITHOUT ROWID), so the values of a data point are read together"""
+
+
+def _check_fields(fields):
+    """field names are inserted in the SQL statements, only the known fields are accepted"""
+    for field in fields:
+        if field not in store_fields:
+            raise KeyError("cannot query on " + str(field) + ", expected one of " + str(store_fields))
+
+def _where(criteria:dict)-> (str, list):
+    """
+    :param criteria dict: field -> value or [values]
+    :return (str, list): WHERE clause (empty without criteria) and its parameters
+    """
+    _check_fields(criteria)
+    clauses = []
+    parameters = []
+    for field, accepted in criteria.items():
+        if not isinstance(accepted, (list, tuple, set)):
+            accepted = [accepted]
+        accepted = list(accepted)
+        clauses.append("d." + field + " IN (" + ", ".join("?" * len(accepted)) + ")")
+        parameters.extend(accepted)
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), parameters
+
+def _restore_drug(frame:pd.DataFrame)-> pd.DataFrame:
+    """drug is stored as 0/1"""
+    if "drug" in frame.columns:
+        frame["drug"] = frame["drug"].map({1: True, 0: False})
+    return frame
+
+def _batches(rows, size:int):
+    """
+    :param rows iterable: rows to insert
+    :param size int: number of rows per batch
+    :return generator: lists of at most size rows
+    """
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+class ResearchStore:
+    """
+    SQLite database containing the data points of several cohorts
+    """
+    def __init__(self, path:str, read_only:bool=False, timeout:float=30.0):
+        """
+        :param path str: database file, created if it does not exist (unless read_only)
+        :param read_only bool: open the database for reading only (e.g. from an analysis notebook)
+        :param timeout float: seconds to wait for the lock held by another connection
+        """
+        self._path = path
+        if read_only:
+            self._connection = sqlite3.connect(pathlib.Path(path).resolve().as_uri() + "?mode=ro", uri=True,
+                                               timeout=timeout, isolation_level=None)
+        else:
+            self._connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+            """transactions are started explicitly (see _transaction)"""
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.executescript(_tables)
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(measurements)")]
+        if columns and "quantity" not in columns:
+            self._connection.close()
+            raise ValueError(str(path) + " stores the volume and intensity side by side (former layout), the cohorts "
+                             "need to be ingested in a new database")
+
+    @property
+    def path(self):
+        return self._path
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """
+        Commit the statements run in the with block, or roll them back on error
+        """
+        self._connection.execute("BEGIN IMMEDIATE")
+        """the write lock is taken at once, concurrent writers wait (timeout) rather than failing later"""
+        try:
+            yield self._connection
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+        self._connection.execute("COMMIT")
+
+    def ingest(self, research, cohort:str, replace:bool=True, batch_size:int=50000)-> int:
+        """
+        Insert the data points of a cohort in one transaction
+        :param research iterable: ResearchData, ColumnarResearchData or data points (e.g. iter_research_points)
+        :param cohort str: name of the cohort, e.g. "CLP290"
+        :param replace bool: delete the data points already stored for the cohort
+        :param batch_size int: number of rows written at once
+        :return int: number of data points inserted
+        """
+        with self._transaction() as connection:
+            if replace:
+                self._delete(connection, cohort)
+            next_id = connection.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM datapoints").fetchone()[0]
+            """ids are assigned here so that the data points and their measurements are inserted in batches"""
+            inserted = 0
+            for batch in _batches(research, batch_size):
+                ids = range(next_id, next_id + len(batch))
+                connection.executemany(
+                    "INSERT INTO datapoints (id, cohort, drug, sex, animal, section, neuron, layer, disease, location,"
+                    " source) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(ident, cohort, point.drug, point.sex, point.animal, point.section, point.neuron, point.layer,
+                      point.disease, point.location, json.dumps(point.source) if point.source is not None else None)
+                     for ident, point in zip(ids, batch)])
+                measurements = ((ident, quantity, position, float(value))
+                                for ident, point in zip(ids, batch)
+                                for quantity in quantities
+                                for position, value in enumerate(getattr(point, quantity)))
+                for rows in _batches(measurements, batch_size):
+                    connection.executemany("INSERT INTO measurements (datapoint, quantity, position, value)"
+                                           " VALUES (?, ?, ?, ?)", rows)
+                next_id += len(batch)
+                inserted += len(batch)
+        return inserted
+
+    @staticmethod
+    def _delete(connection:sqlite3.Connection, cohort:str):
+        connection.execute("DELETE FROM measurements WHERE datapoint IN (SELECT id FROM datapoints WHERE cohort = ?)",
+                           (cohort,))
+        connection.execute("DELETE FROM datapoints WHERE cohort = ?", (cohort,))
+
+    def delete(self, cohort:str):
+        """
+        :param cohort str: cohort whose data points are deleted
+        :return: None
+        """
+        with self._transaction() as connection:
+            self._delete(connection, cohort)
+
+    def cohorts(self)-> list:
+        """
+        :return list: names of the cohorts stored
+        """
+        return [row[0] for row in self._connection.execute("SELECT DISTINCT cohort FROM datapoints ORDER BY cohort")]
+
+    def query(self, sql:str, parameters=None)-> pd.DataFrame:
+        """
+        Run any SELECT statement on the tables datapoints and measurements
+        :param sql str: the statement
+        :param parameters: values of the ? placeholders
+        :return pd.DataFrame: the result
+        """
+        return pd.read_sql_query(sql, self._connection, params=parameters)
+
+    def datapoints(self, **criteria)-> pd.DataFrame:
+        """
+        :param criteria: field=value or field=[values] (see store_fields), all criteria must be met
+        :return pd.DataFrame: one row per data point (id, cohort and metadata fields)
+        """
+        where, parameters = _where(criteria)
+        return _restore_drug(self.query("SELECT d.id, " + ", ".join("d." + field for field in store_fields) +
+                                        " FROM datapoints d" + where + " ORDER BY d.id", parameters))
+
+    def measurements(self, **criteria)-> pd.DataFrame:
+        """
+        :param criteria: field=value or field=[values] (see store_fields), all criteria must be met
+        :return pd.DataFrame: one row per value with the metadata fields of its data point, the quantity ("volume" or
+        "intensity"), the position in the list of the data point and the value
+        """
+        where, parameters = _where(criteria)
+        return _restore_drug(self.query(
+            "SELECT d.id AS datapoint, " + ", ".join("d." + field for field in store_fields) +
+            ", m.quantity, m.position, m.value FROM datapoints d JOIN measurements m ON m.datapoint = d.id" + where +
+            " ORDER BY d.id, m.quantity DESC, m.position", parameters))
+        """volumes first, as in the data points"""
+
+    def aggregate(self, *fields, **criteria)-> pd.DataFrame:
+        """
+        Count, sum and mean of the volume and intensity values of all the neurons of each group, and the density
+        (intensity sum / volume sum), computed by SQLite (same columns as ResearchData.aggregate)
+        :param fields: fields to group by (see store_fields), no field aggregates all the data points selected
+        :param criteria: field=value or field=[values], all criteria must be met
+        :return pd.DataFrame: one row per group, indexed by the fields
+        """
+        _check_fields(fields)
+        where, parameters = _where(criteria)
+        columns = ", ".join("d." + field for field in fields)
+        values = "CASE WHEN m.quantity = '{0}' THEN m.value END"
+        measures = ", ".join(("COUNT(" + values + ") AS {0}_count, TOTAL(" + values + ") AS {0}_sum, AVG(" + values +
+                              ") AS {0}_mean").format(name) for name in quantities)
+        sql = ("SELECT " + (columns + ", " if fields else "") + measures +
+               ", TOTAL(" + values.format("intensity") + ") / NULLIF(TOTAL(" + values.format("volume") +
+               "), 0) AS density"
+               " FROM datapoints d LEFT JOIN measurements m ON m.datapoint = d.id" + where +
+               (" GROUP BY " + columns + " ORDER BY " + columns if fields else ""))
+        frame = _restore_drug(self.query(sql, parameters))
+        if fields:
+            frame = frame.set_index(list(fields))
+        return frame
+
+    def load(self, **criteria)-> ResearchData:
+        """
+        Build the data points stored, e.g. load(cohort="CLP290", sex="male")
+        :param criteria: field=value or field=[values] (see store_fields), all criteria must be met
+        :return ResearchData: the data points
+        """
+        where, parameters = _where(criteria)
+        research = ResearchData()
+        points = {}
+        rows = self._connection.execute("SELECT d.id, " + ", ".join("d." + field for field in query_fields) +
+                                        ", d.source FROM datapoints d" + where + " ORDER BY d.id", parameters)
+        for row in rows:
+            fields = dict(zip(query_fields, row[1:-1]))
+            if fields["drug"] is not None:
+                fields["drug"] = bool(fields["drug"])
+            points[row[0]] = (IntensityVolumeData(source=json.loads(row[-1]) if row[-1] is not None else None,
+                                                  **fields), [], [])
+        values = self._connection.execute(
+            "SELECT m.datapoint, m.quantity, m.value FROM datapoints d JOIN measurements m ON m.datapoint = d.id" +
+            where + " ORDER BY m.datapoint, m.quantity, m.position", parameters)
+        for ident, quantity, value in values:
+            _, volumes, intensities = points[ident]
+            (volumes if quantity == "volume" else intensities).append(value)
+        for point, volume, intensity in points.values():
+            point.volume = volume
+            point.intensity = intensity
+            research.add_data(point)
+        return research
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
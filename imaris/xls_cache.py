@@ -0,0 +1,320 @@
+"""Persistent cache of the parsed Excel sheets
+
+Parsing the .xls files is the slowest step of the analysis while the files almost never change. Each parsed sheet is
+stored as columns in a .npz file, keyed by the content hash of the Excel file. The path, size and modification time
+of the Excel files are kept in an index so that unchanged files are not even hashed again.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+INDEX_NAME = "index.json"
+"""name of the file (in the cache folder) indexing the Excel files by path"""
+
+_cache = None
+"""the cache used by read_excel, None if the cache is disabled"""
+
+
+def _hash_file(path:str, content:bytes=None)-> str:
+    """
+    :param path str: file path
+    :param content bytes: content of the file if it was already read (e.g. prefetched), the file is not read again
+    :return str: hash of the file content
+    """
+    if content is not None:
+        return hashlib.sha1(content).hexdigest()
+    digest = hashlib.sha1()
+    with open(path, "rb") as infile:
+        for chunk in iter(lambda: infile.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _replace(path:str, write):
+    """
+    Write a file atomically so that concurrent processes never read a partially written file
+    :param path str: final file path
+    :param write function: called with the temporary file path
+    :return: None
+    """
+    temp_path = path + "." + str(os.getpid()) + ".tmp"
+    try:
+        write(temp_path)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+class SheetCache:
+    """
+    Folder containing one .npz file per parsed sheet, with a size-bounded (least recently used) eviction.
+    """
+    def __init__(self, cache_dir:str, max_bytes:int=2 * 1024 ** 3):
+        """
+        :param cache_dir str: folder of the cache, created if needed
+        :param max_bytes int: maximum size of the cached sheets, the least recently used are removed beyond it
+        """
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self._index = self._load_index()
+        """Excel file path -> {"size", "mtime", "hash"}"""
+        self._size = None
+        """size of the cached sheets, scanned once then kept up to date by _store and evict"""
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    def _load_index(self)-> dict:
+        try:
+            with open(os.path.join(self._cache_dir, INDEX_NAME)) as infile:
+                return json.load(infile)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self):
+        def write(temp_path):
+            with open(temp_path, "w") as outfile:
+                json.dump(self._index, outfile)
+        _replace(os.path.join(self._cache_dir, INDEX_NAME), write)
+
+    def file_hash(self, path:str, content:bytes=None)-> str:
+        """
+        Content hash of an Excel file, only recomputed when the path, size or modification time changed
+        :param path str: Excel file path
+        :param content bytes: content of the file if it was already read
+        :return str: the hash
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = self._index.get(path)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime_ns:
+            entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": _hash_file(path, content)}
+            self._index[path] = entry
+            self._save_index()
+        return entry["hash"]
+
+    def contains(self, path:str, sheets:dict, header:int=0, dtype:dict=None)-> bool:
+        """
+        If the sheets can be read from the cache without reading the Excel file: the file is indexed with its current
+        size and modification time, and all the sheets are cached (see prefetch, cached files are not prefetched)
+        :param path str: Excel file path
+        :param sheets dict: sheet name -> list of the columns to read
+        :param header int: row of the column names
+        :param dtype dict: column name -> dtype
+        :return bool: True if no sheet would be parsed by read_sheets
+        """
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        entry = self._index.get(path)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime_ns:
+            return False
+        return all(os.path.exists(self._sheet_path(entry["hash"], sheet, columns, header, dtype))
+                   for sheet, columns in sheets.items())
+
+    def _sheet_path(self, file_hash:str, sheet:str, columns:list, header:int, dtype:dict)-> str:
+        key = hashlib.sha1(json.dumps([sheet, columns, header, dtype], sort_keys=True).encode()).hexdigest()[:16]
+        return os.path.join(self._cache_dir, file_hash + "_" + key + ".npz")
+
+    def read_sheets(self, path:str, sheets:dict, header:int=0, dtype:dict=None, open_excel=None,
+                    content:bytes=None)-> dict:
+        """
+        Same as parse_sheets, only the sheets missing from the cache are parsed
+        :param path str: Excel file path
+        :param sheets dict: sheet name -> list of the columns to read (None reads all the columns)
+        :param header int: row of the column names
+        :param dtype dict: column name -> dtype
+        :param open_excel function: returns the opened Excel file (pd.ExcelFile), only called if a sheet is missing
+        :param content bytes: content of the file if it was already read (hashed instead of reading the file again)
+        :return dict: sheet name -> pd.DataFrame
+        """
+        file_hash = self.file_hash(path, content)
+        parsed = {}
+        missing = {}
+        for sheet, columns in sheets.items():
+            frame = self._load(self._sheet_path(file_hash, sheet, columns, header, dtype))
+            if frame is None:
+                missing[sheet] = columns
+            else:
+                parsed[sheet] = frame
+        if missing:
+            excel_file = open_excel() if open_excel is not None else path
+            for sheet, frame in parse_sheets(excel_file, missing, header=header, dtype=dtype).items():
+                self._store(self._sheet_path(file_hash, sheet, missing[sheet], header, dtype), frame)
+                parsed[sheet] = frame
+            self.evict()
+        return {sheet: parsed[sheet] for sheet in sheets}
+
+    def _load(self, sheet_path:str):
+        """
+        :param sheet_path str: .npz file of the sheet
+        :return pd.DataFrame: the sheet, None if it is not in the cache
+        """
+        try:
+            with np.load(sheet_path) as stored:
+                columns = json.loads(str(stored["columns"]))
+                data = {}
+                for position, (name, kind) in enumerate(columns):
+                    values = stored[str(position)]
+                    if kind == "text":
+                        values = values.astype(object)
+                        values[stored[str(position) + "_missing"]] = np.nan
+                    data[position] = values
+        except (OSError, KeyError, ValueError):
+            return None
+        try:
+            os.utime(sheet_path)
+            """the modification time of the cached sheet records its last use, for the eviction"""
+        except OSError:
+            pass
+            """evicted by another process since it was loaded"""
+        frame = pd.DataFrame(data)
+        frame.columns = [name for name, _ in columns]
+        return frame
+
+    def _store(self, sheet_path:str, frame:pd.DataFrame):
+        """
+        Save each column of the sheet as an array. Numeric columns keep their dtype, other columns are stored as text.
+        :param sheet_path str: .npz file of the sheet
+        :param frame pd.DataFrame: the parsed sheet
+        :return: None
+        """
+        arrays = {}
+        columns = []
+        for position in range(frame.shape[1]):
+            values = frame.iloc[:, position].to_numpy()
+            if values.dtype.kind in "biufcmM":
+                columns.append([frame.columns[position], "number"])
+            else:
+                missing = pd.isna(values)
+                arrays[str(position) + "_missing"] = missing
+                values = np.where(missing, "", values).astype(str)
+                columns.append([frame.columns[position], "text"])
+            arrays[str(position)] = values
+        arrays["columns"] = np.array(json.dumps(columns, default=str))
+
+        def write(temp_path):
+            with open(temp_path, "wb") as outfile:
+                np.savez(outfile, **arrays)
+        try:
+            replaced = os.path.getsize(sheet_path)
+        except OSError:
+            replaced = 0
+        _replace(sheet_path, write)
+        if self._size is not None:
+            try:
+                self._size += os.path.getsize(sheet_path) - replaced
+            except OSError:
+                self._size -= replaced
+
+    def size(self)-> int:
+        """
+        :return int: size in bytes of all the cached sheets
+        """
+        return sum(entry.stat().st_size for entry in os.scandir(self._cache_dir) if entry.name.endswith(".npz"))
+
+    def evict(self):
+        """
+        Remove the least recently used sheets until the cache is smaller than max_bytes. The folder is only scanned
+        when the size counted by this process is over max_bytes (sheets stored by other processes are counted then).
+        :return: None
+        """
+        if self._size is None:
+            self._size = self.size()
+        if self._size <= self._max_bytes:
+            return
+        entries = [entry for entry in os.scandir(self._cache_dir) if entry.name.endswith(".npz")]
+        entries = sorted(((entry.stat().st_mtime_ns, entry.stat().st_size, entry.path) for entry in entries))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self._max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self._size = total
+
+    def clear(self):
+        """
+        Remove all the cached sheets and the index
+        :return: None
+        """
+        for entry in os.scandir(self._cache_dir):
+            if entry.name.endswith(".npz") or entry.name == INDEX_NAME:
+                os.remove(entry.path)
+        self._index = {}
+        self._size = 0
+
+
+def enable_cache(cache_dir:str, max_bytes:int=2 * 1024 ** 3)-> SheetCache:
+    """
+    Cache the sheets read through read_excel in the given folder
+    :param cache_dir str: folder of the cache
+    :param max_bytes int: maximum size of the cache
+    :return SheetCache: the cache
+    """
+    global _cache
+    _cache = SheetCache(cache_dir, max_bytes)
+    return _cache
+
+def disable_cache():
+    global _cache
+    _cache = None
+
+def get_cache():
+    """
+    :return SheetCache: the cache in use, None if disabled
+    """
+    return _cache
+
+def parse_sheets(excel_file, sheets:dict, header:int=0, dtype:dict=None)-> dict:
+    """
+    Parse some columns of some sheets of an Excel file opened once
+    :param excel_file: Excel file path or opened Excel file (pd.ExcelFile)
+    :param sheets dict: sheet name -> list of the columns to read (None reads all the columns)
+    :param header int: row of the column names
+    :param dtype dict: column name -> dtype, for the columns read
+    :return dict: sheet name -> pd.DataFrame
+    """
+    if not isinstance(excel_file, pd.ExcelFile):
+        with pd.ExcelFile(excel_file) as opened:
+            return parse_sheets(opened, sheets, header=header, dtype=dtype)
+    parsed = {}
+    for sheet, columns in sheets.items():
+        sheet_dtype = None
+        if dtype is not None:
+            sheet_dtype = {column: dtype[column] for column in dtype if columns is None or column in columns}
+        parsed[sheet] = excel_file.parse(sheet, header=header, usecols=columns, dtype=sheet_dtype)
+        if columns is not None:
+            parsed[sheet] = parsed[sheet][columns]
+            """same column order whatever the order in the sheet"""
+    return parsed
+
+def read_sheets(path:str, sheets:dict, header:int=0, dtype:dict=None, open_excel=None, content:bytes=None)-> dict:
+    """
+    Read some columns of some sheets of an Excel file, through the cache if it is enabled (see enable_cache)
+    :param path str: Excel file path
+    :param sheets dict: sheet name -> list of the columns to read (None reads all the columns)
+    :param header int: row of the column names
+    :param dtype dict: column name -> dtype, for the columns read
+    :param open_excel function: returns the opened Excel file (pd.ExcelFile), the file is opened from path if None
+    :param content bytes: content of the file if it was already read (e.g. prefetched)
+    :return dict: sheet name -> pd.DataFrame
+    """
+    if _cache is None:
+        excel_file = open_excel() if open_excel is not None else path
+        return parse_sheets(excel_file, sheets, header=header, dtype=dtype)
+    return _cache.read_sheets(path, sheets, header=header, dtype=dtype, open_excel=open_excel, content=content)
@@ -1,262 +1,414 @@
-import os
+import io
+import logging
+import numpy as np
 import pandas as pd
-import json
-from model import IntensityVolumeData,ResearchData
+from .model import IntensityVolumeData
+from .matcher import PositionIndex, NO_MATCH, matching_strategies
+from .xls_cache import read_sheets
+from .schema import get_schema, kcc2_schema
+from .pairing import get_info
+from . import instrumentation
+
+logger = logging.getLogger(__name__)
+"""diagnostics are logged, and recorded in the run report when instrumentation is turned on"""
 
 # Threshold to ignore small relative and/or absolute difference
 relative_value_threshold = 0.015
 absolute_value_threshold = 2
 intensity_trigger = 10
 
+# Matching of the neurons between the intensity and volume files
+matching_strategy = "unique"
+"""see matcher.matching_strategies: "unique" keeps the neurons having exactly one neuron within tolerance,
+"assignment" resolves ambiguous neurons with a global one-to-one assignment (nearest pairs first)"""
+
+low_confidence_threshold = 0.2
+"""assignments with a lower confidence (see matcher.assign_candidates) are recorded in the run report"""
+
+def get_settings(**overrides)-> dict:
+    """
+    The thresholds and matching strategy are read once by the caller and passed to the readers, so that worker
+    processes (which do not share the module variables of the caller) and the data point sources use the same values
+    :param overrides: relative_value_threshold, absolute_value_threshold, intensity_trigger or matching_strategy,
+    ignored if None
+    :return dict: setting name -> value, the module variables unless overridden
+    """
+    settings = {"relative_value_threshold": relative_value_threshold,
+                "absolute_value_threshold": absolute_value_threshold,
+                "intensity_trigger": intensity_trigger,
+                "matching_strategy": matching_strategy}
+    for name, value in overrides.items():
+        if name not in settings:
+            raise KeyError("unknown setting " + name + ", expected one of " + str(list(settings)))
+        if value is not None:
+            settings[name] = value
+    return settings
+
 # Excel file Tab identification
 """Each Excel file contains different tabs with data concerning the intensity mean of neurons. Each tab contains the 
-results for a 'channel'. Each channel represents the location of the neurons in the spinal cord location/layer """
+results for a 'channel'. Each channel represents the location of the neurons in the spinal cord location/layer.
+The channels, the tabs, the columns and the file naming convention are described by a schema (see schema), the
+readers use the default schema (kcc2) unless another one is given.
+The module variables below describe the default schema and are kept for compatibility, the readers do not use them."""
 
-membrane_channels = ["Intensity Mean Ch=10 Img=1","Intensity Mean Ch=12 Img=1","Intensity Mean Ch=14 Img=1",
-                     "Intensity Mean Ch=16 Img=1"]
+membrane_channels = kcc2_schema.channel_names("membrane")
 """list of tab names for membrane channels """
 
-intra_channels = [  "Intensity Mean Ch=9 Img=1","Intensity Mean Ch=11 Img=1","Intensity Mean Ch=13 Img=1",
-                    "Intensity Mean Ch=15 Img=1"]
+intra_channels = kcc2_schema.channel_names("intra")
 """list of tab names for intracellular channels """
 
-layer_dict = {"Intensity Mean Ch=10 Img=1":1,
-        "Intensity Mean Ch=12 Img=1":2,
-        "Intensity Mean Ch=14 Img=1":3,
-        "Intensity Mean Ch=16 Img=1":4,
-        "Intensity Mean Ch=9 Img=1":1,
-        "Intensity Mean Ch=11 Img=1":2,
-        "Intensity Mean Ch=13 Img=1":3,
-        "Intensity Mean Ch=15 Img=1":4
-        }
+layer_dict = {channel.name: channel.layer for channel in kcc2_schema.channels}
 """Dictionary to identify which channel [key] represents which layer [value] """
 
-"""The Excel files follow a strict naming convention
-drug_sex_animal_section_neuron_disease_type.xls
-
-drug -> d (drug) or n (no drug) 
-sex -> m (male) or f (female) 
-animal -> integer 1 to 12 (animal number)
-section -> integer 1 to 3 (section number)
-neuron -> i (inhibitory) or e (excitatory)
-disease -> c (contra) or i (ipsi) 
-type -> i (intensity) or v (volume)
-"""
-
-info_dict = {
-    0:{"d":True,
-       "n":False},
-    1:{"m":"male",
-       "f":"female"},
-    2: None,
-    3: None,
-    4: {"e":"excitatory",
-        "i":"inhibitory"},
-    5: {"i":"ipsi",
-        "c":"contra"},
-}
-
-"""Dictionary to translate file naming convention in booleans or strings
-  keys (integers) represent the position in the file name"""
-
-def set_info(info:list, model:IntensityVolumeData):
+sum_sheet_dict = {channel.name: channel.sum_sheet for channel in kcc2_schema.channels}
+"""Dictionary to identify the tab holding the intensity sum [value] of each channel [key] """
+
+position_columns = kcc2_schema.columns["position"]
+volume_columns = kcc2_schema.columns["volume"]
+sum_columns = kcc2_schema.columns["sum"]
+mean_columns = kcc2_schema.columns["mean"]
+"""Columns read in each kind of tab, the other columns are not parsed"""
+
+column_dtypes = kcc2_schema.dtypes
+"""Dictionary of the type of each column read"""
+
+info_dict = {position: translation for position, (_, translation) in enumerate(kcc2_schema.fields)}
+"""Dictionary to translate file naming convention (drug_sex_animal_section_neuron_disease_type.xls) in booleans or
+strings, keys (integers) represent the position in the file name"""
+
+type_dict = kcc2_schema.types
+"""last field of the file name, the type of file"""
+
+def set_info(info:list, model:IntensityVolumeData, schema=None):
     """
     set the model (IntensityVolumeData) information (drug, sex, animal, section, neuron, disease) from the file name
     (info) according to the naming convention.
     :param info list: parsed file name (from get_info)
     :param model IntensityVolumeData: model containing information and data
+    :param schema: Schema or name of a registered schema, the default schema if None
     :return: None
     """
-    model.drug = info_dict[0][info[0]]
-    model.sex = info_dict[1][info[1]]
-    model.animal = info[2]
-    model.section = info[3]
-    model.neuron = info_dict[4][info[4]]
-    model.disease = info_dict[5][info[5]]
-
-def get_info(file:str)->list:
+    get_schema(schema).set_info(info, model)
+
+def check_info(info:list, file:str=None, schema=None):
     """
-    Parse the file name accordingly
-    :param file str: Excel file path
-    :return: List of identifiers to understand the content of the file
+    Check that a parsed file name (from get_info) follows the naming convention
+    drug_sex_animal_section_neuron_disease_type.xls
+    :param info list: parsed file name
+    :param file str: Excel file path, used in the error message
+    :param schema: Schema or name of a registered schema, the default schema if None
+    :return: None
+    :raise ValueError: if the file name does not follow the naming convention
     """
-    _, name = os.path.split(file)
-    name = name.split(".xls")[0]
-    info = name.split("_")
-    return info
+    get_schema(schema).check_info(info, file)
 
-def get_membrane_data(channel:str,intensity_data:pd.DataFrame,volume_data:pd.DataFrame)-> (list,list):
+def match_neurons(intensity_data:dict,volume_data:dict,volume_index:PositionIndex=None,
+                  strategy:str=None,relative_threshold:float=None,absolute_threshold:float=None,
+                  file:str=None)-> pd.DataFrame:
     """
-    Match intensity data to volume data
+    Match all the neurons of the intensity file with the neurons of the volume file, once per file pair.
     Intensity data and Volume data are separated in two different files.
     Neurons do not have the same identifier number. They are matched thanks to their positions (x,y,z)
 
     X, Y, Z coordinates need to match as regard to both the relative adn absolute threshold.
+    LOGIC: look for  all neurons that are either in the acceptable relative distance OR
+            in an acceptable absolute distance.
+    Normally only one neuron will match. With the "assignment" strategy, neurons with several candidates are
+    matched to the nearest free one and a volume neuron is never matched twice.
 
     NOTE: As a result of high quality software resolution, a simple coordinate analysis is sufficient to identify the neurons.
           There is no need for more complex pairing calculation.
 
+    :param intensity_data dict: Data in the intensity file ("Position" and "Volume" tabs)
+    :param volume_data dict: Data in the volume file ("Position" and "Volume" tabs)
+    :param volume_index PositionIndex: index of the volume file positions (optional)
+    :param strategy str: "unique" or "assignment" (see matcher.matching_strategies), matching_strategy if None
+    :param relative_threshold float: relative position tolerance, relative_value_threshold if None
+    :param absolute_threshold float: absolute position tolerance, absolute_value_threshold if None
+    :param file str: intensity file path, used in the diagnostics
+    :return pd.DataFrame: indexed by the intensity neuron ID, with the position, number of candidates, matching volume
+    neuron ID ("ID intra", -1 if not matched), the distance and confidence of the match (NaN if not matched or with
+    the "unique" strategy) and the total, intra and membrane volumes
+    """
+    if volume_index is None:
+        volume_index = PositionIndex.from_frame(volume_data["Position"])
+    if strategy is None:
+        strategy = matching_strategy
+    if relative_threshold is None:
+        relative_threshold = relative_value_threshold
+    if absolute_threshold is None:
+        absolute_threshold = absolute_value_threshold
+
+    idents = intensity_data["Position"]["ID"].to_numpy()
+    positions = intensity_data["Position"][["Position X", "Position Y", "Position Z"]].to_numpy(dtype=float)
+    """x, y, z coordinates of the neurons"""
+    if strategy == "unique":
+        matches, counts = volume_index.match(positions, relative_threshold, absolute_threshold)
+        distances = np.full(len(idents), np.nan)
+        confidence = np.full(len(idents), np.nan)
+    elif strategy == "assignment":
+        matches, distances, confidence, counts = volume_index.assign(positions, relative_threshold,
+                                                                     absolute_threshold)
+    else:
+        raise ValueError("unknown matching strategy " + str(strategy) + ", expected one of " + str(matching_strategies))
+
+    matched = matches != NO_MATCH
+    volume_idents = volume_data["Position"]["ID"].to_numpy()
+    idents_intra = np.full(len(idents), -1, dtype=np.int64)
+    idents_intra[matched] = volume_idents[matches[matched]]
+    low_confidence = np.flatnonzero(confidence < low_confidence_threshold)
+    """NaN (not matched or "unique") is never low"""
+    instrumentation.count(file, None, "low_confidence", len(low_confidence))
+    for row in low_confidence:
+        instrumentation.error("low_confidence", file=file, id=idents[row], id_intra=idents_intra[row],
+                              distance=distances[row], confidence=confidence[row], candidates=counts[row],
+                              x=positions[row, 0], y=positions[row, 1], z=positions[row, 2])
+        logger.debug("low_confidence: ID %s assigned to intra ID %s at distance %s, confidence %s", idents[row],
+                     idents_intra[row], distances[row], confidence[row])
+    volume_totals = intensity_data["Volume"].set_index("ID")["Volume"].reindex(idents).to_numpy(dtype=float)
+    """total volume of each neuron, here is is expected that the ID is unique"""
+    volume_intras = volume_data["Volume"].set_index("ID")["Volume"].reindex(idents_intra).to_numpy(dtype=float)
+    """get intracelullar volume from the Volume file for the matching neuron"""
+    return pd.DataFrame({"Position X": positions[:, 0],
+                         "Position Y": positions[:, 1],
+                         "Position Z": positions[:, 2],
+                         "Candidates": counts,
+                         "Matched": matched,
+                         "ID intra": idents_intra,
+                         "Distance": distances,
+                         "Confidence": confidence,
+                         "Volume total": volume_totals,
+                         "Volume intra": volume_intras,
+                         "Volume membrane": volume_totals - volume_intras},
+                        index=pd.Index(idents, name="ID"))
+
+def get_membrane_data(channel:str,intensity_data:pd.DataFrame,volume_data:pd.DataFrame,
+                      volume_index:PositionIndex=None,file:str=None,strategy:str=None,
+                      neurons:pd.DataFrame=None,schema=None,trigger:float=None)-> (list,list):
+    """
+    Match intensity data to volume data for a channel.
+    The neurons are matched once per file pair (see match_neurons) and the matches are shared by all the channels:
+    for each channel, the neurons above the intensity trigger are joined on their ID with the matches.
+
     :param channel str: Name of the channel tab (Excel file Tab)
     :param intensity_data pd.DataFrame: Data in the intensity file
     :param volume_data pd.DataFrame: Data in the volume file
+    :param volume_index PositionIndex: index of the volume file positions, built once per file (optional)
+    :param file str: intensity file path, used in the diagnostics
+    :param strategy str: "unique" or "assignment" (see matcher.matching_strategies), matching_strategy if None
+    :param neurons pd.DataFrame: result of match_neurons for the file pair, computed if None
+    :param schema: Schema or name of a registered schema describing the channel, the default schema if None
+    :param trigger float: intensity sums below are ignored, intensity_trigger if None
     :return (list,list): list0 volume and list1 intensity. Each index representing the same neuron.
     """
-    volume = []
-    intensity = []
-    for index, row in intensity_data[channel].iterrows():
-
-        intensity_sum = row["Intensity Sum"]
-        """iterates through all neurons on the channel"""
-        if intensity_sum > intensity_trigger:
-            """ small intensities are ignored"""
-            ident = row.ID
-            """get the neuron ID to get the total volume of the neuron"""
-            matching_volume = intensity_data["Volume"][intensity_data["Volume"]["ID"] == ident]
-            """here is is expected that the ID is unique """
-
-            volume_total = float(matching_volume["Volume"])
-            """total volume of the neuron"""
-
-            matching_position = intensity_data["Position"][intensity_data["Position"]["ID"] == ident]
-            """retrieve x, y, z coordinates of the given neuron"""
-            intensity_x = float(matching_position["Position X"])
-            intensity_y = float(matching_position["Position Y"])
-            intensity_z = float(matching_position["Position Z"])
-
-            matching_volume_position_x = volume_data["Position"][( ((volume_data["Position"]["Position X"] > (1-relative_value_threshold)*intensity_x) & (volume_data["Position"]["Position X"] < (1+relative_value_threshold)*intensity_x)) | ((volume_data["Position"]["Position X"] > intensity_x-absolute_value_threshold) & (volume_data["Position"]["Position X"] < intensity_x+absolute_value_threshold)))]
-            matching_volume_position_y = volume_data["Position"][( ((volume_data["Position"]["Position Y"] > (1-relative_value_threshold)*intensity_y) & (volume_data["Position"]["Position Y"] < (1+relative_value_threshold)*intensity_y)) | ((volume_data["Position"]["Position Y"] > intensity_y-absolute_value_threshold) & (volume_data["Position"]["Position Y"] < intensity_y+absolute_value_threshold)))]
-            matching_volume_position_z = volume_data["Position"][( ((volume_data["Position"]["Position Z"] > (1-relative_value_threshold)*intensity_z) & (volume_data["Position"]["Position Z"] < (1+relative_value_threshold)*intensity_z)) | ((volume_data["Position"]["Position Z"] > intensity_z-absolute_value_threshold) & (volume_data["Position"]["Position Z"] < intensity_z+absolute_value_threshold)))]
-            """match for x,y and z all the neurons in the volume file that are considered close to the neurons 
-            in the intensity file.
-            LOGIC: look for  all neurons that are either in the acceptable relative distance OR
-                    in an acceptable absolute distance.
-             """
-
-            matching_volume_position_x_index = matching_volume_position_x.index.tolist()
-            matching_volume_position_y_index = matching_volume_position_y.index.tolist()
-            matching_volume_position_z_index = matching_volume_position_z.index.tolist()
-            """get the list of neurons that can match the given intensity neuron (row) """
-
-            matching_index = list(set(matching_volume_position_x_index) & set(matching_volume_position_y_index) & set(matching_volume_position_z_index))
-            """get the common index for the 3 coordinates
-             Normally only one neuron will match"""
-            if len(matching_index) !=1:
-                print("--------------")
-                print("----- ERROR -----")
-                print(channel)
-                print("ID", ident)
-                print("Volume total", volume_total)
-                print("INTENSITY SUM Value", intensity_sum)
-                print("X,Y,Z", intensity_x,intensity_y,intensity_z)
-                print("Matching X",matching_volume_position_x_index)
-                print("Matching Y", matching_volume_position_y_index)
-                print("Matching Z", matching_volume_position_z_index)
-                print("MATCHING", matching_index)
-                print("--------------")
-            else:
-                ident_intra = int(volume_data["Position"].iloc[matching_index]["ID"])
-                volume_intra = float(volume_data["Volume"][volume_data["Position"]["ID"] == ident_intra]["Volume"])
-                """get intracelullar volume from the Volume file for the matching neuron"""
-                volume_membrane = volume_total - volume_intra
-                """calculates the membrane volume"""
-
-                intensity.append(intensity_sum)
-                if channel in membrane_channels:
-                    if volume_membrane < 0:
-                        print("--------------")
-                        print("----- ERROR -----")
-                        print("ERROR: negative volume")
-                        print(channel)
-                        print("ID intensity", ident)
-                        print("ID intra", ident_intra)
-                        print("X,Y,Z", intensity_x, intensity_y, intensity_z)
-                        print("MATCHING index", matching_index)
-                        print("volume total", volume_total)
-                        print("Volume intra", volume_intra)
-                        print("volume membrane",volume_membrane)
-                        print("--------------")
-                    else:
-                        volume.append(volume_membrane)
-                elif channel in intra_channels:
-                    volume.append(volume_intra)
-                """Adding volume depending on location (intra vs membrane) """
-    return volume, intensity
-
-def read_xls(intensity_file:str, volume_file:str)-> list:
-    print("\n\n---------------------------- !!!!!!!!!!!!!!!!!!!!!! ----------------------\n")
-    print("STARTING ANALYSIS FOR ", intensity_file, "and ", volume_file)
-    models = []
-    info = get_info(intensity_file)
-
-
-    intensity_data = pd.read_excel(intensity_file, sheet_name=["Position", 'Volume',
-                                                               "Intensity Sum Ch=9 Img=1","Intensity Sum Ch=10 Img=1",
-                                                               "Intensity Sum Ch=11 Img=1","Intensity Sum Ch=12 Img=1",
-                                                               "Intensity Sum Ch=13 Img=1","Intensity Sum Ch=14 Img=1",
-                                                               "Intensity Sum Ch=15 Img=1","Intensity Sum Ch=16 Img=1"],
-                                    header = 1)
-
-    volume_data = pd.read_excel(volume_file, sheet_name= ["Position", 'Volume'],header = 1)
+    if strategy is None:
+        strategy = matching_strategy
+    if trigger is None:
+        trigger = intensity_trigger
+    if neurons is None:
+        neurons = match_neurons(intensity_data, volume_data, volume_index=volume_index, strategy=strategy)
+
+    channel_data = intensity_data[channel]
+    above_trigger = channel_data["Intensity Sum"] > trigger
+    channel_data = channel_data[above_trigger]
+    """ small intensities are ignored"""
+    instrumentation.count(file, channel, "below_trigger", int(len(above_trigger) - above_trigger.sum()))
+
+    idents = channel_data["ID"].to_numpy()
+    intensity_sums = channel_data["Intensity Sum"].to_numpy(dtype=float)
+    channel_neurons = neurons.reindex(idents)
+    matched = channel_neurons["Matched"].fillna(False).to_numpy(dtype=bool)
+    candidates = channel_neurons["Candidates"].fillna(0).to_numpy(dtype=int)
+    volume_totals = channel_neurons["Volume total"].to_numpy(dtype=float)
+    volume_intras = channel_neurons["Volume intra"].to_numpy(dtype=float)
+    volume_membranes = channel_neurons["Volume membrane"].to_numpy(dtype=float)
+    positions = channel_neurons[["Position X", "Position Y", "Position Z"]].to_numpy(dtype=float)
+
+    for row in np.flatnonzero(~matched):
+        if candidates[row] == 0:
+            kind = "no_match"
+        elif strategy == "unique":
+            kind = "ambiguous_match"
+        else:
+            kind = "assigned_elsewhere"
+            """all the candidates were matched with nearer neurons"""
+        intensity_x, intensity_y, intensity_z = positions[row]
+        instrumentation.count(file, channel, kind)
+        instrumentation.error(kind, file=file, channel=channel, id=idents[row], volume_total=volume_totals[row],
+                              intensity_sum=intensity_sums[row], x=intensity_x, y=intensity_y, z=intensity_z,
+                              candidates=candidates[row])
+        logger.debug("%s: %s ID %s at X,Y,Z %s %s %s, %s matching neurons", kind, channel, idents[row],
+                     intensity_x, intensity_y, intensity_z, candidates[row])
+
+    intensity = intensity_sums[matched]
+    channel_schema = get_schema(schema).channel(channel)
+    location = channel_schema.location if channel_schema is not None else None
+    if location == "membrane":
+        negative = matched & (volume_membranes < 0)
+        for row in np.flatnonzero(negative):
+            intensity_x, intensity_y, intensity_z = positions[row]
+            ident_intra = int(channel_neurons["ID intra"].iloc[row])
+            instrumentation.count(file, channel, "negative_volume")
+            instrumentation.error("negative_volume", file=file, channel=channel, id=idents[row],
+                                  id_intra=ident_intra, x=intensity_x, y=intensity_y, z=intensity_z,
+                                  volume_total=volume_totals[row], volume_intra=volume_intras[row],
+                                  volume_membrane=volume_membranes[row])
+            logger.debug("negative_volume: %s ID %s (intra ID %s), volume total %s, volume intra %s",
+                         channel, idents[row], ident_intra, volume_totals[row], volume_intras[row])
+        volume = volume_membranes[matched & ~negative]
+        """the intensity of neurons with a negative membrane volume is kept, not their volume"""
+    elif location == "intra":
+        volume = volume_intras[matched]
+    else:
+        volume = volume_intras[:0]
+    """Adding volume depending on location (intra vs membrane) """
+    instrumentation.count(file, channel, "matched", len(volume))
+    return volume.tolist(), intensity.tolist()
+
+class Workbook:
+    """
+    Excel file opened at most once (and only if some tabs are not in the cache), shared by the readers
+    e.g. read_xls and read_xls_intensity_mean can read the same Workbook.
+    """
+    def __init__(self, path:str, content:bytes=None):
+        """
+        :param path str: Excel file path
+        :param content bytes: content of the file if it was already read (see prefetch), the file is then not read
+        from path
+        """
+        self._path = path
+        self._content = content
+        self._excel_file = None
+
+    @property
+    def path(self):
+        return self._path
+
+    def _open(self)-> pd.ExcelFile:
+        if self._excel_file is None:
+            with instrumentation.stage("open", self._path):
+                self._excel_file = pd.ExcelFile(io.BytesIO(self._content) if self._content is not None else self._path)
+        return self._excel_file
+
+    def read(self, sheets:dict, dtype:dict=None, header:int=1)-> dict:
+        """
+        :param sheets dict: tab name -> list of the columns to read
+        :param dtype dict: column name -> dtype, column_dtypes if None
+        :param header int: row of the column names
+        :return dict: tab name -> pd.DataFrame
+        """
+        if dtype is None:
+            dtype = column_dtypes
+        with instrumentation.stage("parse", self._path):
+            return read_sheets(self._path, sheets, header=header, dtype=dtype, open_excel=self._open,
+                               content=self._content)
+
+    def read_plan(self, plan)-> dict:
+        """
+        :param plan ParsePlan: tabs, columns and dtypes to read (see Schema.plan)
+        :return dict: tab name -> pd.DataFrame
+        """
+        return self.read(plan.sheets, dtype=plan.dtype, header=plan.header)
+
+    def close(self):
+        if self._excel_file is not None:
+            self._excel_file.close()
+            self._excel_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _open_workbook(file)-> Workbook:
+    """
+    :param file: Excel file path or Workbook
+    :return Workbook: the workbook, a new one if file is a path
+    """
+    return file if isinstance(file, Workbook) else Workbook(file)
 
-    for channel in membrane_channels+intra_channels:
+def read_xls(intensity_file, volume_file, schema=None, settings:dict=None)-> list:
+    """
+    generates a model for each channel, matching the neurons of the intensity file with the volume file
+    :param intensity_file: intensity file path or Workbook
+    :param volume_file: volume file path or Workbook
+    :param schema: Schema or name of a registered schema, the default schema if None
+    :param settings dict: thresholds and matching strategy (see get_settings), the module variables if None
+    :return list: IntensityVolumeData for each channel
+    """
+    schema = get_schema(schema)
+    if settings is None:
+        settings = get_settings()
+    intensity_workbook = _open_workbook(intensity_file)
+    volume_workbook = _open_workbook(volume_file)
+    logger.info("starting analysis for %s and %s", intensity_workbook.path, volume_workbook.path)
+    models = []
+    info = get_info(intensity_workbook.path)
+
+    try:
+        intensity_sheets = intensity_workbook.read_plan(schema.plan("intensity"))
+        volume_data = volume_workbook.read_plan(schema.plan("volume"))
+    finally:
+        if intensity_workbook is not intensity_file:
+            intensity_workbook.close()
+        if volume_workbook is not volume_file:
+            volume_workbook.close()
+    intensity_data = {"Position": intensity_sheets["Position"], "Volume": intensity_sheets["Volume"]}
+    intensity_data.update({channel.name: intensity_sheets[channel.sum_sheet] for channel in schema.channels})
+    """channels are identified by their intensity mean tab name, the data is the one of the intensity sum tab"""
+    with instrumentation.stage("match", intensity_workbook.path):
+        neurons = match_neurons(intensity_data, volume_data, strategy=settings["matching_strategy"],
+                                relative_threshold=settings["relative_value_threshold"],
+                                absolute_threshold=settings["absolute_value_threshold"],
+                                file=intensity_workbook.path)
+    """the neurons are matched once, the matches are shared by all channels"""
+
+    for channel in schema.channels:
         model = IntensityVolumeData()
         models.append(model)
-        if channel in membrane_channels:
-            model.location = "membrane"
-        if channel in intra_channels:
-            model.location = "intra"
-
-        model.layer = layer_dict[channel]
-
-        set_info(info=info, model=model)
-        volume_vals , intensity_vals = get_membrane_data(channel=channel,intensity_data=intensity_data,volume_data=volume_data)
+        model.location = channel.location
+        model.layer = channel.layer
+
+        schema.set_info(info, model)
+        with instrumentation.stage("select", intensity_workbook.path):
+            volume_vals , intensity_vals = get_membrane_data(channel=channel.name,intensity_data=intensity_data,
+                                                              volume_data=volume_data,neurons=neurons,
+                                                              file=intensity_workbook.path,schema=schema,
+                                                              strategy=settings["matching_strategy"],
+                                                              trigger=settings["intensity_trigger"])
         model.volume = volume_vals
         model.intensity = intensity_vals
 
     return models
 
-def read_xls_intensity_mean(intensity_file:str,)-> list:
+def read_xls_intensity_mean(intensity_file, schema=None)-> list:
     """
     generates a model with Intensity mean as opposed to intensity sum and with no volume files (no matching)
-    :param intensity_file:
-    :return:
+    :param intensity_file: intensity file path or Workbook
+    :param schema: Schema or name of a registered schema, the default schema if None
+    :return list: IntensityVolumeData for each channel
     """
-    print("\n\n---------------------------- !!!!!!!!!!!!!!!!!!!!!! ----------------------\n")
-    print("STARTING ANALYSIS FOR ", intensity_file)
+    schema = get_schema(schema)
+    intensity_workbook = _open_workbook(intensity_file)
+    logger.info("starting analysis for %s", intensity_workbook.path)
     models = []
-    info = get_info(intensity_file)
-
+    info = get_info(intensity_workbook.path)
 
-    intensity_data = pd.read_excel(intensity_file, sheet_name=[
-                                                               "Intensity Mean Ch=9 Img=1","Intensity Mean Ch=10 Img=1",
-                                                               "Intensity Mean Ch=11 Img=1","Intensity Mean Ch=12 Img=1",
-                                                               "Intensity Mean Ch=13 Img=1","Intensity Mean Ch=14 Img=1",
-                                                               "Intensity Mean Ch=15 Img=1","Intensity Mean Ch=16 Img=1"],
-                                    header = 1)
+    try:
+        intensity_data = intensity_workbook.read_plan(schema.plan("intensity_mean"))
+    finally:
+        if intensity_workbook is not intensity_file:
+            intensity_workbook.close()
 
-
-    for channel in intra_channels + membrane_channels:
+    for channel in sorted(schema.channels, key=lambda channel: channel.location != "intra"):
+        """intracellular channels first, the order of the intensity mean models"""
         model = IntensityVolumeData()
         models.append(model)
-        if channel in membrane_channels:
-            model.location = "membrane"
-        if channel in intra_channels:
-            model.location = "intra"
-        model.intensity = list(intensity_data[channel]["Intensity Mean"])
-        model.layer = layer_dict[channel]
-
-        set_info(info=info, model=model)
-        # volume_vals , intensity_vals = get_membrane_data(channel=channel,intensity_data=intensity_data,volume_data=volume_data)
-        # model.volume = volume_vals
-        # model.intensity = intensity_vals
-
-    return models
+        model.location = channel.location
+        model.intensity = list(intensity_data[channel.mean_sheet]["Intensity Mean"])
+        model.layer = channel.layer
 
+        schema.set_info(info, model)
 
-if __name__ == '__main__':
-    models = read_xls(r"./data/CLP290/intensity_intramem/d_f_2_1_e_c_i.xls", r"./data/CLP290/intra/d_f_2_1_e_c_v.xls") #type:list
-    research = ResearchData()
-    for model in models:
-        research.add_data(point=model)
-    with open("model.json", "w") as outfile:
-        json.dump(research.to_json(), outfile, indent=4, separators=(',', ': '))
\ No newline at end of file
+    return models
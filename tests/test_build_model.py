@@ -0,0 +1,143 @@
+"""Tests of the incremental build (python -m pytest tests), on synthetic workbooks (benchmarks/synthetic.py)"""
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+
+pytest.importorskip("xlwt")
+"""the synthetic workbooks are written with xlwt"""
+
+import numpy as np
+import synthetic
+from imaris import build_model
+from imaris.build_model import build_research_data, load_model
+from imaris.normalization import ContraBaseline, normalize_research_data
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    """
+    :return (str, list): folder containing the intensity and intra folders, and the (intensity file, volume file) pairs
+    (contra and ipsi of two animals)
+    """
+    return str(tmp_path), synthetic.generate_dataset(str(tmp_path), pairs=4, neurons=20)
+
+@pytest.fixture
+def reads(monkeypatch):
+    """
+    :return list: intensity files read by build_research_data, appended as they are read
+    """
+    read = []
+    read_xls = build_model.read_xls
+
+    def counting_read_xls(intensity_file, volume_file, **kwargs):
+        read.append(intensity_file)
+        return read_xls(intensity_file=intensity_file, volume_file=volume_file, **kwargs)
+    monkeypatch.setattr(build_model, "read_xls", counting_read_xls)
+    return read
+
+def _build(folder:str, name:str, **kwargs):
+    return build_research_data(os.path.join(folder, "intensity"), os.path.join(folder, "intra"), incremental=True,
+                               name=os.path.join(folder, name), **kwargs)
+
+def _content(research)-> list:
+    """data points as sortable tuples"""
+    return sorted((point.drug, point.sex, point.animal, point.section, point.neuron, point.layer, point.disease,
+                   point.location, list(point.volume), list(point.intensity), sorted(point.source.items()))
+                  for point in research)
+
+def _pair_files(research)-> set:
+    return {point.source["intensity_file"] for point in research}
+
+
+@pytest.mark.parametrize("name", ["model.json", "model.npz"])
+def test_unchanged_rebuild_reuses_every_pair(dataset, reads, name):
+    folder, pairs = dataset
+    first = _build(folder, name)
+    assert len(reads) == len(pairs)
+    reads.clear()
+    second = _build(folder, name)
+    """the sources of the saved model compare equal after the json (or npz) round trip"""
+    assert reads == []
+    assert _content(second) == _content(first)
+
+@pytest.mark.parametrize("name", ["model.json", "model.npz"])
+def test_touched_file_is_reprocessed(dataset, reads, name):
+    folder, pairs = dataset
+    first = _build(folder, name)
+    touched = pairs[1][0]
+    stat = os.stat(touched)
+    os.utime(touched, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    reads.clear()
+    second = _build(folder, name)
+    assert reads == [touched]
+    assert len(second) == len(first)
+    assert all(point.source["intensity_mtime"] == stat.st_mtime_ns + 10 ** 9
+               for point in second if point.source["intensity_file"] == touched)
+
+def test_deleted_pair_is_dropped(dataset, reads):
+    folder, pairs = dataset
+    first = _build(folder, "model.json")
+    deleted = pairs[2]
+    for file in deleted:
+        os.remove(file)
+    reads.clear()
+    second = _build(folder, "model.json")
+    assert reads == []
+    assert _pair_files(second) == _pair_files(first) - {deleted[0]}
+    assert _content(second) == _content(point for point in first if point.source["intensity_file"] != deleted[0])
+    assert _content(load_model(os.path.join(folder, "model.json"))) == _content(second)
+
+
+def _file_name(pair:tuple)-> str:
+    """file name without the type, e.g. d_f_1_1_e_c"""
+    return os.path.basename(pair[0])[:-len("_i.xls")]
+
+def _assert_same_normalized(research, expected):
+    def by_key(points):
+        return {(point.drug, point.sex, point.animal, point.section, point.neuron, point.layer, point.location):
+                np.asarray(point.intensity) for point in points}
+    research = by_key(research)
+    expected = by_key(expected)
+    assert sorted(research) == sorted(expected)
+    for key in expected:
+        np.testing.assert_allclose(research[key], expected[key], rtol=1e-12)
+
+def test_incremental_baseline_equals_full_recompute(dataset, monkeypatch):
+    folder, pairs = dataset
+    normalized_name = os.path.join(folder, "normalized.json")
+    _build(folder, "model.json", normalized_name=normalized_name)
+    assert os.path.exists(os.path.join(folder, "model.baseline.json"))
+    contra = [pair for pair in pairs if _file_name(pair).endswith("_c")]
+    synthetic.generate_pair(folder, _file_name(contra[0]), neurons=25, seed=99)
+    """other values: the baseline of the first animal changes"""
+    for file in contra[1]:
+        os.remove(file)
+    """the baseline of the second animal is removed, its ipsi data points are not normalized"""
+
+    recomputed = []
+    add_research_data = ContraBaseline.add_research_data
+
+    def counting_add_research_data(baseline, research):
+        recomputed.append(len(research))
+        add_research_data(baseline, research)
+    monkeypatch.setattr(ContraBaseline, "add_research_data", counting_add_research_data)
+    model = _build(folder, "model.json", normalized_name=normalized_name)
+    assert recomputed == []
+    """the saved baseline was updated, not computed again"""
+    monkeypatch.undo()
+    _assert_same_normalized(load_model(normalized_name), normalize_research_data(model))
+    assert {point.animal for point in load_model(normalized_name)} == {_file_name(contra[0]).split("_")[2]}
+
+def test_stale_baseline_is_not_reused(dataset):
+    folder, pairs = dataset
+    normalized_name = os.path.join(folder, "normalized.json")
+    _build(folder, "model.json", normalized_name=normalized_name)
+    synthetic.generate_pair(folder, _file_name(pairs[0]), neurons=25, seed=99)
+    _build(folder, "model.json")
+    """the model is saved without its baseline, which now describes the former model"""
+    model = _build(folder, "model.json", normalized_name=normalized_name)
+    _assert_same_normalized(load_model(normalized_name), normalize_research_data(model))
@@ -0,0 +1,76 @@
+"""Tests of the neuron matching (python -m pytest tests)"""
+
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from imaris.matcher import NO_MATCH, PositionIndex, assign_candidates
+
+
+def _sequential_greedy(query:np.ndarray, rows:np.ndarray, distances:np.ndarray, count:int)-> np.ndarray:
+    """
+    Reference assignment: the candidate pairs are taken one at a time, nearest first (ties in the order of the pairs),
+    and kept if both the query and the row are still free
+    """
+    matches = np.full(count, NO_MATCH, dtype=np.int64)
+    used_rows = set()
+    for pair in np.argsort(distances, kind="stable"):
+        if matches[query[pair]] == NO_MATCH and rows[pair] not in used_rows:
+            matches[query[pair]] = rows[pair]
+            used_rows.add(rows[pair])
+    return matches
+
+def test_assign_candidates_is_sequential_greedy():
+    rng = np.random.default_rng(0)
+    for _ in range(300):
+        count = int(rng.integers(1, 15))
+        row_count = int(rng.integers(1, 15))
+        pairs = {(int(rng.integers(count)), int(rng.integers(row_count))) for _ in range(int(rng.integers(0, 40)))}
+        pairs = sorted(pairs)
+        query = np.array([pair[0] for pair in pairs], dtype=np.int64)
+        rows = np.array([pair[1] for pair in pairs], dtype=np.int64)
+        distances = rng.integers(0, 4, size=len(pairs)).astype(np.float64)
+        """few distinct distances, so that many pairs are tied"""
+        matches, match_distances, confidence = assign_candidates(query, rows, distances, count)
+        expected = _sequential_greedy(query, rows, distances, count)
+        np.testing.assert_array_equal(matches, expected)
+        matched = matches != NO_MATCH
+        assert np.all(np.isnan(match_distances[~matched])) and np.all(np.isnan(confidence[~matched]))
+        assert np.all((confidence[matched] >= 0) & (confidence[matched] <= 1))
+
+def _baseline_candidates(positions:np.ndarray, volume:np.ndarray, relative_threshold:float,
+                         absolute_threshold:float)-> set:
+    """
+    Reference candidates: the three masks of the original reader, relative OR absolute tolerance on each axis, the
+    volume neuron being a candidate if it is within tolerance on x AND y AND z
+    """
+    pairs = set()
+    for query, position in enumerate(positions):
+        masks = [(((volume[:, axis] > (1 - relative_threshold) * position[axis]) &
+                   (volume[:, axis] < (1 + relative_threshold) * position[axis])) |
+                  ((volume[:, axis] > position[axis] - absolute_threshold) &
+                   (volume[:, axis] < position[axis] + absolute_threshold)))
+                 for axis in range(3)]
+        pairs.update((query, int(row)) for row in np.flatnonzero(masks[0] & masks[1] & masks[2]))
+    return pairs
+
+def test_candidates_are_the_baseline_masks():
+    rng = np.random.default_rng(1)
+    for relative_threshold, absolute_threshold in [(0.015, 2), (0.2, 0.5), (0.0, 1), (0.5, 0)]:
+        for _ in range(50):
+            volume = rng.integers(-20, 200, size=(int(rng.integers(1, 40)), 3)).astype(np.float64)
+            volume[rng.random(len(volume)) < 0.2] *= -1
+            volume[rng.random(len(volume)) < 0.1, int(rng.integers(3))] = 0
+            """negative and null coordinates, on which the relative interval is empty"""
+            positions = np.concatenate([volume[rng.integers(len(volume), size=10)] +
+                                        rng.choice([0, 0.5, -1, 2, -2, 3], size=(10, 3)),
+                                        rng.uniform(-30, 210, size=(10, 3))])
+            """near duplicates of the volume neurons (some exactly on the bounds) and random coordinates"""
+            query, rows = PositionIndex(volume).candidates(positions, relative_threshold, absolute_threshold)
+            assert len(set(zip(query.tolist(), rows.tolist()))) == len(query)
+            assert set(zip(query.tolist(), rows.tolist())) == _baseline_candidates(positions, volume,
+                                                                                  relative_threshold,
+                                                                                  absolute_threshold)
+            assert np.all(np.diff(query) >= 0)
@@ -0,0 +1,31 @@
+"""Tests of the SQLite store (python -m pytest tests)"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from imaris.model import IntensityVolumeData, ResearchData
+from imaris.store import ResearchStore
+
+
+def _point(volume:list, intensity:list, animal:str="1")-> IntensityVolumeData:
+    return IntensityVolumeData(drug=True, sex="male", animal=animal, section="1", neuron="excitatory", layer=1,
+                               disease="ipsi", location="membrane", volume=volume, intensity=intensity)
+
+def test_volume_and_intensity_are_stored_separately(tmp_path):
+    research = ResearchData()
+    research.add_data(_point([60.0], [100.0, 200.0]))
+    """the first neuron had a negative membrane volume: its intensity is kept, not its volume"""
+    research.add_data(_point([1.0, 2.0], [3.0, 4.0], animal="2"))
+    with ResearchStore(str(tmp_path / "store.db")) as store:
+        assert store.ingest(research, "A") == 2
+        values = store.measurements(animal="1")
+        assert values[values["quantity"] == "volume"]["value"].tolist() == [60.0]
+        assert values[values["quantity"] == "intensity"]["value"].tolist() == [100.0, 200.0]
+        aggregated = store.aggregate("animal")
+        assert aggregated.loc["1", "volume_count"] == 1 and aggregated.loc["1", "intensity_count"] == 2
+        assert aggregated.loc["1", "density"] == 300.0 / 60.0
+        loaded = sorted(store.load(), key=lambda point: point.animal)
+        assert [list(point.volume) for point in loaded] == [[60.0], [1.0, 2.0]]
+        assert [list(point.intensity) for point in loaded] == [[100.0, 200.0], [3.0, 4.0]]